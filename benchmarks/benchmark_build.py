@@ -0,0 +1,309 @@
+"""Build-scaling benchmark with a synthetic Sphinx project.
+
+Generates a math-heavy Sphinx project
+and builds it with client side rendering
+and with ``katex_prerender = True``,
+each with ``sphinx-build -j 1`` to ``-j N``.
+For every build the wall time,
+the peak resident memory of all Python and all nodejs processes,
+and the size of the output folder are reported.
+
+The size of the project is controlled by
+the number of pages,
+the number of equations per page,
+the fraction of display equations,
+the fraction of equations that repeat an earlier equation,
+and the number of macros in ``katex_options``.
+Run it with::
+
+    $ uv run python benchmarks/benchmark_build.py --pages 200 --jobs 4
+
+Every build starts from an empty output and doctree folder.
+The peak memory is only measured on Linux.
+
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+SYMBOLS = [
+    r"\alpha",
+    r"\beta",
+    r"\omega",
+    r"\mathbf{x}",
+    r"\mathbf{x}_0",
+    r"t",
+    r"k",
+    r"\phi",
+]
+
+
+def macro_name(n):
+    # KaTeX macros may only contain letters
+    letters = ""
+    n += 1
+    while n > 0:
+        n, rest = divmod(n - 1, 26)
+        letters = chr(ord("a") + rest) + letters
+    return f"\\macro{letters}"
+
+
+def random_equation(rng, macros, display):
+    """Random equation, larger for display math."""
+    terms = rng.randint(4, 16) if display else rng.randint(1, 3)
+    parts = []
+    for _ in range(terms):
+        symbol = rng.choice(SYMBOLS)
+        if macros and rng.random() < 0.3:
+            symbol = rf"{macro_name(rng.randrange(macros))}{{{symbol}}}"
+        kind = rng.random()
+        if kind < 0.3:
+            symbol = rf"\frac{{{symbol}}}{{{rng.choice(SYMBOLS)}}}"
+        elif kind < 0.5:
+            symbol = rf"\sqrt{{{symbol}}}"
+        elif kind < 0.7:
+            symbol = rf"{symbol}^{{{rng.randint(2, 9)}}}"
+        parts.append(symbol)
+    equation = " + ".join(parts)
+    if display:
+        equation = (
+            rf"\int_{{-\infty}}^{{\infty}} {equation}"
+            rf" \operatorname{{d}}\!{rng.choice(SYMBOLS)}"
+        )
+    return equation
+
+
+def generate_project(
+    path,
+    *,
+    pages=100,
+    equations=50,
+    display_ratio=0.2,
+    duplicate_ratio=0.3,
+    macros=20,
+    seed=1,
+):
+    """Write a synthetic Sphinx project to ``path``.
+
+    Args:
+        path: folder of the project
+        pages: number of pages
+        equations: number of equations per page
+        display_ratio: fraction of display equations
+        duplicate_ratio: fraction of equations
+            repeating an earlier equation
+        macros: number of macros in ``katex_options``
+        seed: seed of the random generator
+
+    Returns:
+        number of equations in the project
+
+    """
+    rng = random.Random(seed)
+    os.makedirs(path, exist_ok=True)
+
+    macro_table = ",\n".join(
+        f'    "\\\\{macro_name(n)[1:]}": "\\\\mathrm{{#1}}_{{{n}}}"'
+        for n in range(macros)
+    )
+    with open(os.path.join(path, "conf.py"), "w") as file:
+        file.write(
+            "extensions = ['sphinxcontrib.katex']\n"
+            "master_doc = 'index'\n"
+            f"katex_options = r'''macros: {{\n{macro_table}\n}}'''\n"
+        )
+
+    names = [f"page{n:05d}" for n in range(pages)]
+    with open(os.path.join(path, "index.rst"), "w") as file:
+        file.write("Benchmark\n=========\n\n.. toctree::\n\n")
+        file.writelines(f"    {name}\n" for name in names)
+
+    seen = {True: [], False: []}
+    for name in names:
+        lines = [name, "=" * len(name), ""]
+        for _ in range(equations):
+            display = rng.random() < display_ratio
+            if seen[display] and rng.random() < duplicate_ratio:
+                equation = rng.choice(seen[display])
+            else:
+                equation = random_equation(rng, macros, display)
+                seen[display].append(equation)
+            if display:
+                lines += ["", ".. math::", "", f"    {equation}", ""]
+            else:
+                lines.append(f"Some text with :math:`{equation}` inline.")
+        with open(os.path.join(path, f"{name}.rst"), "w") as file:
+            file.write("\n".join(lines) + "\n")
+    return pages * equations
+
+
+def process_tree(pid):
+    """Process IDs and names of ``pid`` and all its children."""
+    parents = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as file:
+                stat = file.read()
+        except OSError:
+            continue
+        # The name can contain spaces and is enclosed in parentheses
+        name = stat[stat.index("(") + 1 : stat.rindex(")")]
+        ppid = int(stat[stat.rindex(")") + 2 :].split()[1])
+        parents[int(entry)] = (ppid, name)
+    tree = {pid: parents.get(pid, (0, ""))[1]}
+    added = True
+    while added:
+        added = False
+        for child, (ppid, name) in parents.items():
+            if ppid in tree and child not in tree:
+                tree[child] = name
+                added = True
+    return tree
+
+
+def resident_memory(pid):
+    try:
+        with open(f"/proc/{pid}/statm") as file:
+            return int(file.read().split()[1]) * PAGE_SIZE
+    except OSError:
+        return 0
+
+
+def folder_size(path):
+    return sum(
+        os.path.getsize(os.path.join(root, file))
+        for root, _, files in os.walk(path)
+        for file in files
+    )
+
+
+def megabytes(size, measured=True):
+    return size / 2**20 if measured else None
+
+
+def build(project, outdir, *, prerender, jobs, interval=0.05):
+    """Build ``project`` and measure time, memory and output size."""
+    command = [
+        sys.executable,
+        "-m",
+        "sphinx",
+        "-b",
+        "html",
+        "-q",
+        "-j",
+        str(jobs),
+        "-d",
+        os.path.join(outdir, ".doctrees"),
+        "-D",
+        f"katex_prerender={int(prerender)}",
+        project,
+        os.path.join(outdir, "html"),
+    ]
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [ROOT] + [p for p in [env.get("PYTHONPATH")] if p]
+    )
+    peak = {"python": 0, "node": 0}
+    measure_memory = os.path.isdir("/proc")
+    start = time.perf_counter()
+    process = subprocess.Popen(command, env=env)
+    while process.poll() is None:
+        if measure_memory:
+            memory = {"python": 0, "node": 0}
+            for pid, name in process_tree(process.pid).items():
+                kind = "node" if name.startswith("node") else "python"
+                memory[kind] += resident_memory(pid)
+            for kind in peak:
+                peak[kind] = max(peak[kind], memory[kind])
+        time.sleep(interval)
+    duration = time.perf_counter() - start
+    if process.returncode != 0:
+        raise RuntimeError(f"Build failed: {' '.join(command)}")
+    return {
+        "prerender": prerender,
+        "jobs": jobs,
+        "wall_time_s": duration,
+        "peak_rss_python_mb": megabytes(peak["python"], measure_memory),
+        "peak_rss_node_mb": megabytes(peak["node"], measure_memory),
+        "output_mb": megabytes(folder_size(os.path.join(outdir, "html"))),
+    }
+
+
+def report(results):
+    print(
+        f"{'mode':<10} {'jobs':>4} {'time/s':>8} "
+        f"{'python/MB':>10} {'node/MB':>8} {'output/MB':>10}"
+    )
+    for result in results:
+        mode = "prerender" if result["prerender"] else "client"
+        python = result["peak_rss_python_mb"]
+        node = result["peak_rss_node_mb"]
+        print(
+            f"{mode:<10} {result['jobs']:>4} {result['wall_time_s']:>8.2f} "
+            f"{python if python is not None else float('nan'):>10.1f} "
+            f"{node if node is not None else float('nan'):>8.1f} "
+            f"{result['output_mb']:>10.1f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--pages", type=int, default=100)
+    parser.add_argument("--equations", type=int, default=50)
+    parser.add_argument("--display-ratio", type=float, default=0.2)
+    parser.add_argument("--duplicate-ratio", type=float, default=0.3)
+    parser.add_argument("--macros", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="build with -j 1 to -j JOBS",
+    )
+    parser.add_argument(
+        "--project",
+        help="keep the generated project in this folder",
+    )
+    parser.add_argument("--json", help="write results to JSON file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        project = args.project or os.path.join(tmpdir, "project")
+        count = generate_project(
+            project,
+            pages=args.pages,
+            equations=args.equations,
+            display_ratio=args.display_ratio,
+            duplicate_ratio=args.duplicate_ratio,
+            macros=args.macros,
+            seed=args.seed,
+        )
+        print(f"{args.pages} pages with {count} equations")
+        results = []
+        for prerender in [False, True]:
+            for jobs in range(1, args.jobs + 1):
+                outdir = tempfile.mkdtemp(dir=tmpdir)
+                results.append(
+                    build(project, outdir, prerender=prerender, jobs=jobs)
+                )
+        report(results)
+
+    if args.json is not None:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+"""Micro-benchmarks of the KaTeX render server.
+
+Measures the latency and throughput
+of the communication between Sphinx and the nodejs render server:
+
+* startup latency of :meth:`KaTeXServer.start`
+  until the first equation is rendered,
+  with and without reusing the compiled KaTeX library
+* latency per equation for small inline and large display math
+* throughput for every transport and message format,
+  rendering one equation after the other
+  and pipelined with :meth:`KaTeXServer.render_iter`
+* latency for growing payloads,
+  including equations larger than the receive buffer of the client
+
+Every measurement is repeated several times after a warm-up
+and the median and 95th percentile are reported.
+Run it with::
+
+    $ uv run python benchmarks/benchmark_server.py
+
+and store the results with ``--json results.json``
+to compare changes against ``--baseline results.json``.
+
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+sys.path.insert(
+    0,
+    os.path.abspath(os.path.join(os.path.dirname(__file__), "..")),
+)
+from sphinxcontrib.katex import KaTeXServer  # noqa: E402
+
+
+INLINE = r"\omega"
+
+DISPLAY = r"""
+\begin{aligned}
+    P(\mathbf{x},\omega) &= \oint_{\partial V}
+        D(\mathbf{x}_0,\omega) G(\mathbf{x}-\mathbf{x}_0,\omega)
+        \operatorname{d}\!A(\mathbf{x}_0) \\
+    I_{ik} &= \left(
+    \begin{array}{lll}
+        \sum m (y^2+z^2) & -\sum m x y & -\sum m x z \\
+        -\sum m y x & \sum m (x^2+z^2) & -\sum m y z \\
+        -\sum m z x & -\sum m z y & \sum m (x^2 + y^2)
+    \end{array}
+    \right)
+\end{aligned}
+"""
+
+TRANSPORTS = ["socket", "tcp", "stdio"]
+PROTOCOLS = ["binary", "json"]
+
+
+def request(latex, display=False):
+    return {"latex": latex, "katex_options": {"displayMode": display}}
+
+
+def large_equation(rows):
+    """Equation with a rendered size growing with ``rows``."""
+    return r"\begin{aligned}" + r"\\".join(
+        rf"x_{{{n}}} &= \frac{{a_{{{n}}}}}{{b_{{{n}}}}}" for n in range(rows)
+    ) + r"\end{aligned}"
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+def summary(durations, count=1):
+    """Median and 95th percentile in microseconds per item."""
+    per_item = [duration / count * 1e6 for duration in durations]
+    return {
+        "median_us": statistics.median(per_item),
+        "p95_us": percentile(per_item, 0.95),
+    }
+
+
+def measure(function, repeat, warmup):
+    for _ in range(warmup):
+        function()
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def start_server(transport, protocol):
+    KaTeXServer.transport = transport
+    KaTeXServer.protocol = protocol
+    return KaTeXServer.start()
+
+
+def benchmark_startup(args):
+    results = {}
+    for transport in TRANSPORTS:
+        servers = []
+
+        def start():
+            server = start_server(transport, "binary")
+            servers.append(server)
+            server.render(request(INLINE))
+
+        durations = measure(start, args.startup_repeat, warmup=1)
+        for server in servers:
+            server.terminate()
+        results[transport] = summary(durations)
+
+    # The warm-up fills the compile cache
+    with tempfile.TemporaryDirectory() as compile_cache:
+        KaTeXServer.compile_cache = compile_cache
+        servers = []
+
+        def start():
+            server = start_server("socket", "binary")
+            servers.append(server)
+            server.render(request(INLINE))
+
+        durations = measure(start, args.startup_repeat, warmup=1)
+        for server in servers:
+            server.terminate()
+        KaTeXServer.compile_cache = None
+    results["socket, compile cache"] = summary(durations)
+    return results
+
+
+def benchmark_latency(args):
+    results = {}
+    server = start_server("socket", "binary")
+    try:
+        for name, equation in [
+            ("inline", request(INLINE)),
+            ("display", request(DISPLAY, display=True)),
+        ]:
+            durations = measure(
+                lambda: server.render(equation),
+                args.repeat,
+                args.warmup,
+            )
+            results[name] = summary(durations)
+    finally:
+        server.terminate()
+    return results
+
+
+def benchmark_throughput(args):
+    equations = [request(rf"x_{{{n}}}") for n in range(args.equations)]
+    results = {}
+    for transport in TRANSPORTS:
+        for protocol in PROTOCOLS:
+            server = start_server(transport, protocol)
+            try:
+
+                def sequential():
+                    for equation in equations:
+                        server.render(equation)
+
+                def pipelined():
+                    for _ in server.render_iter(equations):
+                        pass
+
+                name = f"{transport}/{protocol}"
+                for mode, function in [
+                    ("sequential", sequential),
+                    ("pipelined", pipelined),
+                ]:
+                    durations = measure(function, args.batch_repeat, 1)
+                    result = summary(durations, count=len(equations))
+                    result["equations_per_s"] = 1e6 / result["median_us"]
+                    results[f"{name}/{mode}"] = result
+            finally:
+                server.terminate()
+    return results
+
+
+def benchmark_payload(args):
+    results = {}
+    server = start_server("socket", "binary")
+    try:
+        for rows in [1, 10, 100, 1000]:
+            equation = request(large_equation(rows), display=True)
+            size = len(server.render(equation)["html"].encode("utf-8"))
+            durations = measure(
+                lambda: server.render(equation),
+                max(1, args.repeat // rows),
+                args.warmup,
+            )
+            result = summary(durations)
+            result["response_bytes"] = size
+            results[f"{rows} rows"] = result
+    finally:
+        server.terminate()
+    return results
+
+
+def environment():
+    node = subprocess.run(
+        ["node", "--version"],
+        capture_output=True,
+        text=True,
+    ).stdout.strip()
+    return {
+        "python": platform.python_version(),
+        "node": node,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def report(results, baseline=None):
+    for group, measurements in results.items():
+        if group == "environment":
+            continue
+        print(f"\n{group}")
+        for name, result in measurements.items():
+            line = f"  {name:<28} {result['median_us']:>10.1f} us"
+            line += f"  (p95 {result['p95_us']:.1f} us)"
+            if "equations_per_s" in result:
+                line += f"  {result['equations_per_s']:>9.0f} eq/s"
+            if "response_bytes" in result:
+                line += f"  {result['response_bytes']:>9d} bytes"
+            if baseline is not None:
+                before = baseline.get(group, {}).get(name)
+                if before is not None:
+                    change = result["median_us"] / before["median_us"] - 1
+                    line += f"  {change:+.1%}"
+            print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--startup-repeat", type=int, default=5)
+    parser.add_argument("--batch-repeat", type=int, default=5)
+    parser.add_argument("--equations", type=int, default=2000)
+    parser.add_argument("--json", help="write results to JSON file")
+    parser.add_argument("--baseline", help="compare with JSON results")
+    args = parser.parse_args()
+
+    results = {
+        "environment": environment(),
+        "startup": benchmark_startup(args),
+        "latency": benchmark_latency(args),
+        "throughput": benchmark_throughput(args),
+        "payload": benchmark_payload(args),
+    }
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    print(json.dumps(results["environment"]))
+    report(results, baseline)
+
+    if args.json is not None:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,38 @@
+const crypto = require("crypto");
+const fs = require("fs");
+const Module = require("module");
 const net = require("net");
+const path = require("path");
 const process = require("process");
+const vm = require("vm");
+const { Worker, isMainThread, parentPort, workerData } = require("worker_threads");
 
 let value = null;
 let katex_options = {};
 let socket = null;
 let port = null;
+// Exchange messages over stdin and stdout instead of a socket
+let stdio = false;
+// Keep running after the starting process exits,
+// so that several builds can share the server
+let daemon = false;
+// Number of worker threads rendering equations,
+// 0 renders on the main thread
+let threads = 0;
+// Time in milliseconds after which a rendering worker is stopped,
+// 0 disables the deadline
+let render_timeout = 0;
 // Default path to the KaTeX Javascript library
 // without `.js` at the end.
 // The default points to the one bundled with the extension.
 // Otherwise the file provided with the `katex_js_path`
 // config setting is used. The path must start with "./".
 let katex_path = "./katex.min";
+// Directory to store the compiled code of KaTeX,
+// null compiles KaTeX on every start
+let compile_cache = null;
+// Convert katex_options from conf.py to JSON instead of starting a server
+let convert_options = false;
 process.argv.forEach(function(arg) {
     if (value == "katex_path") {
         katex_path = arg;
@@ -21,6 +43,15 @@ process.argv.forEach(function(arg) {
     } else if (value == "socket_port") {
         port = arg;
         value = null;
+    } else if (value == "threads") {
+        threads = parseInt(arg);
+        value = null;
+    } else if (value == "render_timeout") {
+        render_timeout = parseFloat(arg);
+        value = null;
+    } else if (value == "compile_cache") {
+        compile_cache = arg;
+        value = null;
     } else {
         if (arg == "--katex") {
             value = "katex_path";
@@ -28,6 +59,18 @@ process.argv.forEach(function(arg) {
             value = "socket_path";
         } else if (arg == "--port") {
             value = "socket_port";
+        } else if (arg == "--stdio") {
+            stdio = true;
+        } else if (arg == "--daemon") {
+            daemon = true;
+        } else if (arg == "--threads") {
+            value = "threads";
+        } else if (arg == "--render-timeout") {
+            value = "render_timeout";
+        } else if (arg == "--compile-cache") {
+            value = "compile_cache";
+        } else if (arg == "--convert-options") {
+            convert_options = true;
         } else {
             // Ignore unknown/unexpected arguments, for example the path to this
             // script
@@ -35,76 +78,335 @@ process.argv.forEach(function(arg) {
     }
 });
 
-const katex = require(katex_path);
+function startServer() {
+    if (stdio) {
+        // Talk to the parent process through our standard streams,
+        // the server stops when the parent closes stdin
+        setupClient({
+            on: (event, callback) => process.stdin.on(event, callback),
+            write: (data) => process.stdout.write(data),
+            cork: () => process.stdout.cork(),
+            uncork: () => process.stdout.uncork(),
+            get writableCorked() {
+                return process.stdout.writableCorked;
+            },
+        });
+        process.stdin.on("end", () => process.exit(0));
+        return;
+    }
 
-let listen_options = {};
-if (socket !== null) {
-    listen_options["path"] = socket;
-} else if (port !== null) {
-    listen_options["port"] = port;
-    // Do not expose the rendering server on the network
-    listen_options["host"] = "127.0.0.1";
-}
+    let listen_options = {};
+    if (socket !== null) {
+        listen_options["path"] = socket;
+    } else if (port !== null) {
+        listen_options["port"] = port;
+        // Do not expose the rendering server on the network
+        listen_options["host"] = "127.0.0.1";
+    }
 
-// Start the network server for processing our sphinx's latex's math equations
-const server = net.createServer();
-server.on("connection", setupClient);
-server.listen(listen_options);
+    // Start the network server for processing our sphinx's latex's math equations
+    const server = net.createServer();
+    server.on("connection", setupClient);
+    server.listen(listen_options, function() {
+        // Announce that we are ready to accept connections,
+        // port 0 lets the operating system select a free port
+        let address = server.address();
+        let ready = { "ready": true };
+        if (typeof address === "string") {
+            ready["socket"] = address;
+        } else {
+            ready["port"] = address.port;
+        }
+        process.stdout.write(JSON.stringify(ready) + "\n");
+    });
 
-function setupClient(client) {
-    // Split the input stream into individual rendering requests
-    // How many bytes are still left in the current request
-    let bytesLeft = null;
-    // List of chunks belonging to the current request
-    let buffer = [];
-    // Any undecoded bytes from the previous chunk, for example we were expecting
-    // a 4-byte integer but only received 2 bytes
-    let undecodedBytes = null;
-    client.on("data", function(chunk) {
-        // If there are any undecoded bytes left from the previous chunk, prepend
-        // them to the current one
-        if (undecodedBytes !== null) {
-            chunk = Buffer.concat([undecodedBytes, chunk]);
-            undecodedBytes = null;
+    if (daemon) {
+        // Closing the server removes its unix socket,
+        // connected clients are not waited for
+        let stop = () => {
+            server.close();
+            process.exit(0);
+        };
+        process.on("SIGTERM", stop);
+        process.on("SIGINT", stop);
+        return;
+    }
+
+    // Stop together with the process that started the server,
+    // which holds the other end of our stdin
+    process.stdin.on("end", () => process.exit(0));
+    process.stdin.resume();
+}
+
+// Pool of worker threads, each with its own KaTeX instance.
+// Requests are queued and handed to the next idle worker,
+// a worker exceeding the render timeout is stopped and replaced.
+// Workers are idle once they have loaded KaTeX,
+// so that loading does not count towards the render timeout.
+class RenderPool {
+    constructor(size, timeout) {
+        this.timeout = timeout;
+        this.queue = [];
+        this.idle = [];
+        this.workers = [];
+        // Why the last worker could not load KaTeX
+        this.error = null;
+        // Option sets registered so far, replayed to replaced workers
+        this.registrations = [];
+        for (let i = 0; i < size; i++) {
+            this.spawn();
         }
+    }
 
-        let start = 0;
-        while (start < chunk.length) {
-            let remainingBytes = chunk.length - start;
-            if (bytesLeft === null) {
-                if (remainingBytes >= 4) {
-                    bytesLeft = chunk.readInt32LE(start);
-                    start += 4;
-                } else {
-                    undecodedBytes = chunk.slice(start);
-                    break;
-                }
+    spawn() {
+        let worker = new Worker(__filename, {
+            workerData: { katex_path: katex_path, compile_cache: compile_cache },
+        });
+        worker.task = null;
+        worker.ready = false;
+        worker.on("message", (response) => {
+            if (worker.ready) {
+                this.finish(worker, response);
+            } else {
+                // The first message announces that KaTeX is loaded
+                worker.ready = true;
+                this.idle.push(worker);
+                this.dispatch();
+            }
+        });
+        worker.on("error", (e) => {
+            if (worker.ready) {
+                this.replace(worker, { "error": e.message });
             } else {
-                if (remainingBytes >= bytesLeft) {
-                    let end = start + bytesLeft;
-                    buffer.push(chunk.slice(start, end));
+                this.abandon(worker, e.message);
+            }
+        });
+        for (let registration of this.registrations) {
+            worker.postMessage(registration);
+        }
+        this.workers.push(worker);
+    }
 
-                    var all = Buffer.concat(buffer);
-                    handleRequest(client, all.toString());
+    abandon(worker, message) {
+        // A worker that cannot load KaTeX is not replaced,
+        // as its replacement would fail in the same way
+        worker.removeAllListeners();
+        this.workers = this.workers.filter((w) => w !== worker);
+        this.error = `Rendering worker could not start: ${message}`;
+        this.dispatch();
+    }
 
-                    bytesLeft = null;
-                    buffer = [];
-                    start = end;
-                } else {
-                    buffer.push(chunk.slice(start));
+    register(registration) {
+        this.registrations.push(registration);
+        for (let worker of this.workers) {
+            worker.postMessage(registration);
+        }
+    }
 
-                    bytesLeft -= remainingBytes;
-                    break;
-                }
+    submit(request, callback) {
+        this.queue.push({ request: request, callback: callback });
+        this.dispatch();
+    }
+
+    dispatch() {
+        if (this.workers.length === 0) {
+            for (let task of this.queue.splice(0)) {
+                task.callback({ "error": this.error });
+            }
+            return;
+        }
+        while (this.idle.length > 0 && this.queue.length > 0) {
+            let worker = this.idle.pop();
+            let task = this.queue.shift();
+            worker.task = task;
+            if (this.timeout > 0) {
+                let message = `Rendering took longer than ${this.timeout} ms`;
+                task.timer = setTimeout(
+                    () => this.replace(worker, { "error": message }),
+                    this.timeout,
+                );
+            }
+            worker.postMessage(task.request);
+        }
+    }
+
+    finish(worker, response) {
+        let task = worker.task;
+        if (task === null) {
+            return;
+        }
+        clearTimeout(task.timer);
+        worker.task = null;
+        this.idle.push(worker);
+        task.callback(response);
+        this.dispatch();
+    }
+
+    replace(worker, response) {
+        // Stop a runaway or crashed worker and answer its request with an error
+        let task = worker.task;
+        worker.task = null;
+        worker.removeAllListeners();
+        worker.terminate();
+        this.idle = this.idle.filter((w) => w !== worker);
+        this.workers = this.workers.filter((w) => w !== worker);
+        this.spawn();
+        if (task !== null) {
+            clearTimeout(task.timer);
+            task.callback(response);
+        }
+        this.dispatch();
+    }
+}
+
+// Option sets registered by clients.
+// Clients name them after a hash of their content,
+// so connections sharing a name share the same options.
+// Options are plain JSON,
+// code sent by clients is never evaluated.
+const optionSets = new Map();
+
+function registerOptions(registration) {
+    let name = registration["register"];
+    let options = registration["katex_options"] || {};
+    if (typeof options !== "object" || Array.isArray(options)) {
+        let error = "Invalid katex_options: expected a JSON object";
+        optionSets.set(name, { "error": error });
+        return { "error": error };
+    }
+    optionSets.set(name, { "options": Object.assign({}, options) });
+    return { "registered": name };
+}
+
+// Write katex_options from conf.py, the body of a Javascript object literal
+// read from stdin, as JSON to stdout.
+// Only the process starting the render server runs this,
+// so that the server never evaluates code sent over its socket.
+function convertOptions() {
+    let source = fs.readFileSync(0, "utf-8");
+    try {
+        let options = new Function(`return {${source}\n};`)();
+        process.stdout.write(JSON.stringify(options));
+    } catch (e) {
+        process.stderr.write(e.message);
+        process.exitCode = 1;
+    }
+}
+
+// Hash identifying the KaTeX library of the server.
+// Clients store rendered equations under it,
+// as the server might render with another library than theirs.
+function libraryHash() {
+    let source = fs.readFileSync(require.resolve(katex_path));
+    return crypto.createHash("sha256").update(source).digest("hex");
+}
+
+function render(request, callback) {
+    if (pool !== null) {
+        pool.submit(request, callback);
+    } else {
+        callback(renderRequest(request));
+    }
+}
+
+// Binary messages start with the protocol version,
+// JSON messages with "{"
+const BINARY_VERSION = 1;
+// Request header: version, flags, length of JSON options, request ID
+const REQUEST_HEADER_SIZE = 8;
+// Response header: version, status, reserved, request ID,
+// render time in microseconds
+const RESPONSE_HEADER_SIZE = 12;
+const FLAG_DISPLAY_MODE = 1;
+// The options of the request contain the name of a registered option set
+const FLAG_OPTION_SET = 2;
+const STATUS_ERROR = 1;
+
+function setupClient(client) {
+    // Split the input stream into individual rendering requests.
+    // Complete messages are handled as views into the received chunk,
+    // chunks are only copied when a message spans several of them.
+    let pending = [];
+    let pendingLength = 0;
+    client.on("data", function(chunk) {
+        if (pendingLength > 0) {
+            pending.push(chunk);
+            pendingLength += chunk.length;
+            if (pending[0].length < 4 && pendingLength >= 4) {
+                pending = [Buffer.concat(pending, pendingLength)];
             }
+            if (pending[0].length < 4 || pendingLength < 4 + pending[0].readInt32LE(0)) {
+                return;
+            }
+            chunk = Buffer.concat(pending, pendingLength);
+            pending = [];
+            pendingLength = 0;
+        }
+
+        let start = 0;
+        while (chunk.length - start >= 4) {
+            let length = chunk.readInt32LE(start);
+            if (chunk.length - start - 4 < length) {
+                break;
+            }
+            handleMessage(client, chunk.subarray(start + 4, start + 4 + length));
+            start += 4 + length;
+        }
+        if (start < chunk.length) {
+            pending.push(chunk.subarray(start));
+            pendingLength = chunk.length - start;
         }
     });
 
     client.on("end", function() {
-        buffer = [];
+        pending = [];
+        pendingLength = 0;
+    });
+
+    // A client going away must not stop the server,
+    // its socket is closed after the error
+    client.on("error", function() {
+        pending = [];
+        pendingLength = 0;
     });
 }
 
+function handleMessage(client, message) {
+    if (message.length > 0 && message[0] == BINARY_VERSION) {
+        handleBinaryRequest(client, message);
+    } else {
+        handleRequest(client, message.toString("utf-8"));
+    }
+}
+
+function handleBinaryRequest(client, message) {
+    let flags = message.readUInt8(1);
+    let optionsLength = message.readUInt16LE(2);
+    let id = message.readUInt32LE(4);
+    let latexStart = REQUEST_HEADER_SIZE + optionsLength;
+
+    let options = {};
+    let optionSet = undefined;
+    if (flags & FLAG_OPTION_SET) {
+        optionSet = message.toString("utf-8", REQUEST_HEADER_SIZE, latexStart);
+    } else if (optionsLength > 0) {
+        try {
+            options = JSON.parse(message.toString("utf-8", REQUEST_HEADER_SIZE, latexStart));
+        } catch (e) {
+            sendBinaryResponse(client, id, { "error": `Could not deserialize options: ${e.message}` });
+            return;
+        }
+    }
+    options["displayMode"] = (flags & FLAG_DISPLAY_MODE) != 0;
+
+    let request = {
+        "latex": message.toString("utf-8", latexStart),
+        "katex_options": options,
+        "options": optionSet,
+    };
+    render(request, (response) => sendBinaryResponse(client, id, response));
+}
+
 function handleRequest(client, serialized) {
     try {
         var request = JSON.parse(serialized);
@@ -115,30 +417,203 @@ function handleRequest(client, serialized) {
         return;
     }
 
+    let respond = function(response) {
+        // Echo the request ID so that clients can match responses to requests
+        if (request["id"] !== undefined) {
+            response["id"] = request["id"];
+        }
+        sendMessage(client, JSON.stringify(response));
+    };
+
+    if (request["register"] !== undefined) {
+        respond(registerOptions(request));
+        if (pool !== null) {
+            pool.register(request);
+        }
+    } else if (request["library"] !== undefined) {
+        try {
+            respond({ "library": libraryHash() });
+        } catch (e) {
+            respond({ "error": `Could not read KaTeX library: ${e.message}` });
+        }
+    } else if (Array.isArray(request["batch"])) {
+        // Render all equations of a batch and answer with a single message
+        let batch = request["batch"];
+        let results = new Array(batch.length);
+        let remaining = batch.length;
+        if (remaining == 0) {
+            respond({ "batch": results });
+        }
+        batch.forEach(function(item, i) {
+            render(item, function(response) {
+                results[i] = response;
+                remaining -= 1;
+                if (remaining == 0) {
+                    respond({ "batch": results });
+                }
+            });
+        });
+    } else {
+        render(request, respond);
+    }
+}
+
+function renderRequest(request) {
+    // Report the render time in microseconds,
+    // so that clients can tell it apart from the time spent waiting
+    let start = process.hrtime.bigint();
+    let elapsed = () => Number((process.hrtime.bigint() - start) / 1000n);
     try {
         let latex = request["latex"];
         let options = request["katex_options"] || {};
+        if (request["options"] !== undefined) {
+            let optionSet = optionSets.get(request["options"]);
+            if (optionSet === undefined) {
+                return { "error": `Unknown option set ${request["options"]}` };
+            } else if (optionSet["error"] !== undefined) {
+                return { "error": optionSet["error"] };
+            }
+            options = Object.assign({}, optionSet["options"], options);
+        }
         // this is where math latex equation is processed
         let html = katex.renderToString(latex, options);
 
-        let response = { "html": html };
-        sendMessage(client, JSON.stringify(response));
+        return { "html": html, "render_time": elapsed() };
     } catch (e) {
-        let response = { "error": e.message };
-        sendMessage(client, JSON.stringify(response));
+        return { "error": e.message, "render_time": elapsed() };
     }
 }
 
 function sendMessage(client, message) {
-    // Encode the message string into bytes
-    let msgBuffer = Buffer.from(message, "utf-8");
+    // Tell the client how many bytes we are going to send,
+    // followed by the actual message
+    let length = Buffer.byteLength(message, "utf-8");
+    let frame = Buffer.allocUnsafe(4 + length);
+    frame.writeInt32LE(length, 0);
+    frame.write(message, 4, "utf-8");
+    writeFrame(client, frame);
+}
 
-    // Tell the client how many bytes we are going to send
-    let lengthBuffer = Buffer.alloc(4);
-    lengthBuffer.writeInt32LE(msgBuffer.length, 0);
-    client.write(lengthBuffer);
+function sendBinaryResponse(client, id, response) {
+    let status = 0;
+    let payload = response["html"];
+    if (payload === undefined) {
+        status = STATUS_ERROR;
+        payload = response["error"];
+    }
+    let length = RESPONSE_HEADER_SIZE + Buffer.byteLength(payload, "utf-8");
+    let frame = Buffer.allocUnsafe(4 + length);
+    frame.writeInt32LE(length, 0);
+    frame.writeUInt8(BINARY_VERSION, 4);
+    frame.writeUInt8(status, 5);
+    frame.writeUInt16LE(0, 6);
+    frame.writeUInt32LE(id, 8);
+    frame.writeUInt32LE(Math.min(response["render_time"] || 0, 0xFFFFFFFF), 12);
+    frame.write(payload, 4 + RESPONSE_HEADER_SIZE, "utf-8");
+    writeFrame(client, frame);
+}
 
-    // Send the actual message
-    client.write(msgBuffer);
+function writeFrame(client, frame) {
+    // Coalesce all responses of the current event loop turn
+    // into a single write
+    if (client.cork !== undefined && !client.writableCorked) {
+        client.cork();
+        process.nextTick(() => client.uncork());
+    }
+    client.write(frame);
 }
 
+// Load KaTeX,
+// reusing the code compiled by an earlier start if possible.
+// Compiled code is stored in a subdirectory of compile_cache
+// for every version of KaTeX and nodejs,
+// failures fall back to compiling KaTeX again
+function loadKaTeX(katex_path, compile_cache) {
+    if (compile_cache === null) {
+        return require(katex_path);
+    }
+    try {
+        fs.mkdirSync(compile_cache, { recursive: true, mode: 0o700 });
+        // The cached code is executed,
+        // so other users must not be able to place files in the directory
+        const info = fs.lstatSync(compile_cache);
+        if (
+            !info.isDirectory() ||
+            (process.getuid !== undefined &&
+                (info.uid !== process.getuid() || (info.mode & 0o077) !== 0))
+        ) {
+            return require(katex_path);
+        }
+        const filename = require.resolve(katex_path);
+        const source = fs.readFileSync(filename, "utf-8");
+        const hash = crypto.createHash("sha256").update(source).digest("hex");
+        const directory = path.join(
+            compile_cache,
+            `${hash.slice(0, 16)}-node${process.version}-${process.arch}`,
+        );
+        fs.mkdirSync(directory, { recursive: true, mode: 0o700 });
+        if (Module.enableCompileCache !== undefined) {
+            // Available since nodejs 22.1
+            Module.enableCompileCache(directory);
+            return require(filename);
+        }
+        return loadCompiled(filename, source, path.join(directory, "katex.bin"));
+    } catch (error) {
+        return require(katex_path);
+    }
+}
+
+// Load a CommonJS module with code cached by V8
+function loadCompiled(filename, source, cache_file) {
+    let cached_data = undefined;
+    try {
+        cached_data = fs.readFileSync(cache_file);
+    } catch (error) {
+        // Not compiled yet
+    }
+    const script = new vm.Script(Module.wrap(source), {
+        filename: filename,
+        cachedData: cached_data,
+    });
+    const module = { exports: {} };
+    script.runInThisContext()(
+        module.exports,
+        require,
+        module,
+        filename,
+        path.dirname(filename),
+    );
+    const katex = module.exports;
+    if (cached_data === undefined || script.cachedDataRejected) {
+        // Functions compiled while rendering are included in the cache
+        katex.renderToString("\\frac{x}{y}", { displayMode: true });
+        // Other servers might read the cache at the same time
+        const temporary = `${cache_file}.${process.pid}.tmp`;
+        fs.writeFileSync(temporary, script.createCachedData());
+        fs.renameSync(temporary, cache_file);
+    }
+    return katex;
+}
+
+// Start the render server, or a rendering worker of its RenderPool
+let katex = null;
+let pool = null;
+if (convert_options) {
+    convertOptions();
+} else if (!isMainThread) {
+    katex = loadKaTeX(workerData.katex_path, workerData.compile_cache);
+    parentPort.on("message", function(request) {
+        if (request["register"] !== undefined) {
+            registerOptions(request);
+        } else {
+            parentPort.postMessage(renderRequest(request));
+        }
+    });
+    parentPort.postMessage({ "ready": true });
+} else if (threads > 0) {
+    pool = new RenderPool(threads, render_timeout);
+    startServer();
+} else {
+    katex = loadKaTeX(katex_path, compile_cache);
+    startServer();
+}
@@ -9,28 +9,49 @@ Sphinx's HTML writer.
 :license: MIT, see LICENSE for details.
 """  # noqa: D205
 
+import argparse
+import asyncio
 import atexit
-from contextlib import closing
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
+import gzip
+import hashlib
+import heapq
+from html import unescape
+import itertools
 import json
+import multiprocessing.util
 import os
 from pathlib import Path
+import queue
 import re
+import select
 import shutil
+import signal
 import socket
 import struct
+from subprocess import DEVNULL
 from subprocess import PIPE
 from subprocess import Popen
 from subprocess import TimeoutExpired
+import sys
 import tempfile
-from tempfile import mkdtemp
 from textwrap import dedent
+import threading
 import time
 
 from docutils import nodes
 from sphinx.errors import ExtensionError
 from sphinx.locale import _
-from sphinx.util.osutil import copyfile
+from sphinx.util import logging
+
+
+try:
+    # Optional brotli compression of static files
+    import brotli
+except ImportError:
+    brotli = None
 
 
 __version__ = '0.9.11'
@@ -40,7 +61,7 @@ filename_autorenderer = 'katex_autorenderer.js'
 SRC_DIR = Path(__file__).parent
 SCRIPT_PATH = str(SRC_DIR / "katex-server.js")
 
-ONE_MILLISECOND = 0.001
+logger = logging.getLogger(__name__)
 
 TIMEOUT_EXPIRED_TEMPLATE = (
     "Rendering {} is taking too long. Try increasing RENDER_TIMEOUT"
@@ -62,9 +83,67 @@ STARTUP_TIMEOUT = 5.0
 # Timeout per rendering request in seconds
 RENDER_TIMEOUT = 5.0
 
+# Additional time to wait for a response in seconds.
+# Render servers with worker threads stop rendering an equation
+# after RENDER_TIMEOUT and answer with an error,
+# clients wait longer, so that only that equation fails
+# and the other equations are rendered by the replaced worker
+RESTART_TIMEOUT = 2.0
+
+# Maximum time to wait for all equations of a batch in seconds
+BATCH_TIMEOUT = 60.0
+
+# Maximum number of requests sent before waiting for responses
+PIPELINE_WINDOW = 256
+
 # nodejs binary to run javascript
 NODEJS_BINARY = "node"
 
+# Number of rendered equations kept in memory during a build
+MEMO_SIZE = 10000
+
+# Environment variable with the address of a running render server
+SERVER_ENVIRONMENT_VARIABLE = "SPHINXCONTRIB_KATEX_SERVER"
+
+# Name of the render cache directory inside the doctree directory
+CACHE_DIRNAME = "katex_cache"
+
+# Name of the static files directory inside the doctree directory
+STATIC_DIRNAME = "katex_static"
+
+# Number of hex digits of the content hash in static file names
+FINGERPRINT_LENGTH = 8
+
+# Static files that are stored precompressed, fonts are compressed already
+PRECOMPRESS_EXTENSIONS = ('.css', '.js')
+
+# File extensions of compressed copies, also without brotli installed
+COMPRESSED_EXTENSIONS = ('.gz', '.br')
+
+# Patterns to find the fonts needed by pre-rendered equations
+CLASS_ATTRIBUTE_PATTERN = re.compile(r'class="([^"]*)"')
+FONT_FACE_PATTERN = re.compile(r'@font-face\s*\{[^}]*\}')
+CSS_RULE_PATTERN = re.compile(r'([^{}@;]+)\{([^{}]*)\}')
+CSS_CLASS_PATTERN = re.compile(r'\.(-?[_a-zA-Z][\w-]*)')
+FONT_FAMILY_PATTERN = re.compile(r'KaTeX_\w+')
+FONT_URL_PATTERN = re.compile(
+    r'url\(([^)]+)\)\s*format\(["\']?([\w-]+)["\']?\)'
+)
+FONT_SRC_PATTERN = re.compile(r'src:[^;}]+')
+CSS_URL_PATTERN = re.compile(r'url\(([^)]+)\)')
+
+# Patterns to replace the attributes of HTML tags
+TAG_PATTERN = re.compile(r'<([a-zA-Z][\w-]*)((?:\s+[\w:-]+="[^"]*")*)(\s*/?)>')
+ATTRIBUTE_PATTERN = re.compile(r'\s+([\w:-]+)="([^"]*)"')
+
+# Classes replacing inline styles of minified equations
+# are named by this prefix and a number
+MINIFY_CLASS_PREFIX = "ks"
+
+# Number of slowest equations listed in the statistics file
+# if katex_prerender_stats does not ask for a report
+STATS_SLOWEST = 10
+
 
 def latex_defs_to_katex_macros(defs):
     r"""Converts LaTeX \def statements to KaTeX macros.
@@ -113,11 +192,301 @@ def get_latex(node):
         return node.astext()  # for Sphinx >= 1.8.0
 
 
+def is_math_node(node):
+    return isinstance(node, (nodes.math, nodes.math_block))
+
+
+def prerendered_latex(self, node, options=None):
+    """HTML of a math node, rendered together with its document."""
+    if not self.document.get('katex_prerendered'):
+        docname = getattr(self.builder, 'current_docname', None)
+        store = prerendered_store(self.builder.env).get(docname)
+        prerender_doctree(self.document, store)
+    if 'katex_html' in node.attributes:
+        html = node['katex_html']
+    else:
+        html = render_latex(get_latex(node), options)
+    if self.builder.config.katex_prerender_minify:
+        # Styles are added to the page by html_page_context()
+        styles = self.document.setdefault('katex_styles', {})
+        html = minify_katex_html(
+            html,
+            styles,
+            keep_namespaces=writes_xhtml(self.builder),
+        )
+    return html
+
+
+def writes_xhtml(builder):
+    """Check if a builder writes XHTML, e.g. for EPUB."""
+    return (
+        builder.name.startswith('epub')
+        or getattr(builder, 'out_suffix', '').endswith('.xhtml')
+    )
+
+
+def minify_katex_html(html, styles, keep_namespaces=False):
+    """Compact the pre-rendered HTML of an equation.
+
+    The MathML and SVG namespaces are removed,
+    as HTML documents do not need them.
+    Inline styles are replaced by classes,
+    so that every style is only written once per page
+    by :func:`katex_style_sheet`.
+
+    Args:
+        html: HTML as returned by :func:`render_latex`
+        styles: dictionary mapping inline styles to class names,
+            new styles are added to it
+        keep_namespaces: if ``True``,
+            the namespaces are kept for XHTML documents,
+            which need them
+
+    Returns:
+        compacted HTML
+
+    """
+    def compact(match):
+        name, attributes, end = match.groups()
+        attributes = [
+            list(attribute)
+            for attribute in ATTRIBUTE_PATTERN.findall(attributes)
+        ]
+        keys = [key for key, _ in attributes]
+        namespaced = (
+            not keep_namespaces
+            and name in ('math', 'svg')
+            and 'xmlns' in keys
+        )
+        if 'style' not in keys and not namespaced:
+            return match.group(0)
+        compacted = []
+        style = ''
+        for key, value in attributes:
+            if key == 'style':
+                style = value
+            elif not (key == 'xmlns' and namespaced):
+                compacted.append([key, value])
+        if style and '<' in unescape(style):
+            # Never write anything that could end the style sheet
+            compacted.append(['style', style])
+        elif style:
+            if style not in styles:
+                styles[style] = '{}{}'.format(
+                    MINIFY_CLASS_PREFIX,
+                    len(styles),
+                )
+            for attribute in compacted:
+                if attribute[0] == 'class':
+                    attribute[1] += ' ' + styles[style]
+                    break
+            else:
+                compacted.append(['class', styles[style]])
+        return '<{}{}{}>'.format(
+            name,
+            ''.join(' {}="{}"'.format(key, value) for key, value in compacted),
+            end,
+        )
+
+    return TAG_PATTERN.sub(compact, html)
+
+
+def katex_style_sheet(styles):
+    """CSS rules for the classes of :func:`minify_katex_html`.
+
+    Declarations are marked as important,
+    so that they override other rules
+    in the same way as inline styles.
+
+    """
+    rules = []
+    for style, class_name in styles.items():
+        declarations = []
+        for declaration in unescape(style).split(';'):
+            declaration = declaration.strip()
+            if declaration and not declaration.endswith('!important'):
+                declaration += '!important'
+            if declaration:
+                declarations.append(declaration)
+        rules.append('.{}{{{}}}'.format(class_name, ';'.join(declarations)))
+    return ''.join(rules)
+
+
+def html_page_context(app, pagename, templatename, context, doctree):
+    """Add the styles of minified equations to a page."""
+    if doctree is None or not doctree.get('katex_styles'):
+        return
+    style_sheet = katex_style_sheet(doctree['katex_styles'])
+    context['metatags'] = context.get('metatags', '') + (
+        '\n<style>{}</style>'.format(style_sheet)
+    )
+
+
+def minified_size(results):
+    """Size of rendered equations before and after minifying them.
+
+    The size after minifying includes the style sheet.
+
+    """
+    styles = {}
+    size = 0
+    minified = 0
+    for html in results:
+        if isinstance(html, KaTeXError):
+            continue
+        size += len(html.encode('utf-8'))
+        minified += len(minify_katex_html(html, styles).encode('utf-8'))
+    minified += len(katex_style_sheet(styles).encode('utf-8'))
+    return size, minified
+
+
+def math_equations(doctree):
+    """Math nodes of a document and their equations.
+
+    Returns:
+        list of math nodes
+        and list of ``(latex, options)`` pairs
+        as expected by :func:`render_latex_batch`
+
+    """
+    # docutils 0.18 renamed `traverse()` to `findall()`
+    findall = getattr(doctree, 'findall', doctree.traverse)
+    math_nodes = []
+    equations = []
+    for node in findall(is_math_node):
+        options = None
+        if isinstance(node, nodes.math_block):
+            options = {"displayMode": True}
+        math_nodes.append(node)
+        equations.append((get_latex(node), options))
+    return math_nodes, equations
+
+
+def prerender_doctree(doctree, store=None):
+    """Render all math of a document with a single request.
+
+    This is done by the process writing the document,
+    so that rendering scales with ``sphinx-build -j N``.
+    Equations found in ``store``
+    are not rendered again.
+
+    """
+    doctree['katex_prerendered'] = True
+    math_nodes, equations = math_equations(doctree)
+    if not equations:
+        return
+    results = render_latex_batch(equations, store)
+    for node, html in zip(math_nodes, results):
+        # Errors are raised by the visitors when rendering the node again
+        if not isinstance(html, KaTeXError):
+            node['katex_html'] = html
+
+
+def prerendered_store(env):
+    """Rendered equations stored in the build environment.
+
+    Dictionary mapping document names
+    to the rendered HTML of their equations.
+
+    """
+    if not hasattr(env, 'katex_prerendered'):
+        env.katex_prerendered = {}
+    return env.katex_prerendered
+
+
+def prerendering(app):
+    return app.config.katex_prerender and app.builder.format == 'html'
+
+
+def prerender_stats(env):
+    """Render statistics of the documents read in this build."""
+    if not hasattr(env, 'katex_stats'):
+        env.katex_stats = {}
+    return env.katex_stats
+
+
+def collecting_stats(app):
+    return prerendering(app) and (
+        app.config.katex_prerender_stats
+        or app.config.katex_prerender_stats_file
+    )
+
+
+def node_location(node, docname):
+    """Source file and line of a node for reports."""
+    source = node.source or docname
+    if node.line is None:
+        return source
+    return '{}:{}'.format(source, node.line)
+
+
+def doctree_read(app, doctree):
+    """Render all math of a document while reading it.
+
+    The rendered HTML is stored in the build environment,
+    so that equations of unchanged documents
+    are not rendered again in later builds.
+
+    """
+    if not prerendering(app):
+        return
+    docname = app.env.docname
+    store = prerendered_store(app.env).setdefault(docname, {})
+    math_nodes, equations = math_equations(doctree)
+    if not equations:
+        return
+    stats = None
+    if collecting_stats(app):
+        stats = KaTeXStats(
+            [node_location(node, docname) for node in math_nodes],
+            app.config.katex_prerender_stats or STATS_SLOWEST,
+        )
+        prerender_stats(app.env)[docname] = stats
+    results = render_latex_batch(equations, store, stats)
+    if stats is not None and app.config.katex_prerender_minify:
+        stats.html_bytes, stats.minified_bytes = minified_size(results)
+
+
+def env_get_outdated(app, env, added, changed, removed):
+    """Read all documents again after the KaTeX library changed.
+
+    Otherwise equations of unchanged documents
+    would be missing from the emptied store.
+
+    """
+    if not getattr(app, '_katex_library_changed', False):
+        return []
+    return sorted(env.found_docs)
+
+
+def env_purge_doc(app, env, docname):
+    prerendered_store(env).pop(docname, None)
+    prerender_stats(env).pop(docname, None)
+
+
+def env_merge_info(app, env, docnames, other):
+    for store, other_store in [
+            (prerendered_store(env), prerendered_store(other)),
+            (prerender_stats(env), prerender_stats(other)),
+    ]:
+        for docname in docnames:
+            if docname in other_store:
+                store[docname] = other_store[docname]
+
+
 def html_visit_math(self, node):
-    self.body.append(self.starttag(node, 'span', '', CLASS='math'))
+    attributes = {}
+    if targeted_rendering(self.builder.config):
+        # Mark the element for the renderer instead of adding delimiters
+        attributes['data-katex'] = 'inline'
+    self.body.append(
+        self.starttag(node, 'span', '', CLASS='math', **attributes)
+    )
 
     if self.builder.config.katex_prerender:
-        self.body.append(render_latex(get_latex(node)))
+        self.body.append(prerendered_latex(self, node))
+    elif attributes:
+        self.body.append(self.encode(get_latex(node)))
     else:
         self.body.append(
             self.builder.config.katex_inline[0]
@@ -141,8 +510,14 @@ def html_visit_displaymath(self, node):
 
     if self.builder.config.katex_prerender:
         # NB: nowrap is always "on" when using prerendering
-        self.body.append(render_latex(get_latex(node), {"displayMode": True}))
+        self.body.append(
+            prerendered_latex(self, node, {"displayMode": True})
+        )
         self.body.append('</div>')
+    elif targeted_rendering(self.builder.config):
+        self.body.append('<span data-katex="display">')
+        self.body.append(self.encode(get_latex(node)))
+        self.body.append('</span></div>\n')
     elif node['nowrap']:
         self.body.append(self.encode(get_latex(node)))
         self.body.append('</div>')
@@ -155,6 +530,10 @@ def html_visit_displaymath(self, node):
     raise nodes.SkipNode
 
 
+def targeted_rendering(config):
+    return config.katex_targeted_render and not config.katex_prerender
+
+
 def builder_inited(app):
     if not (
             app.config.katex_js_path
@@ -171,46 +550,376 @@ def builder_inited(app):
     add_js = getattr(app, 'add_js_file', old_js_add)
     # Ensure the static path is setup to hold KaTeX CSS and autorender files
     setup_static_path(app)
-    # KaTeX CSS
-    add_css(app.config.katex_css_path)
+    if not app.config.katex_dist_path:
+        # KaTeX CSS,
+        # when bundling the local KaTeX distribution
+        # it is added after reading all documents
+        add_css(app.config.katex_css_path)
     if not app.config.katex_prerender:
         # KaTeX JS
-        add_js(app.config.katex_js_path)
-        copy_file(app, app.config.katex_js_path)
-        # KaTeX auto-renderer
-        add_js(app.config.katex_autorender_path)
-        copy_file(app, app.config.katex_autorender_path)
+        add_js(copy_file(app, app.config.katex_js_path))
+        if not app.config.katex_targeted_render:
+            # KaTeX auto-renderer
+            add_js(copy_file(app, app.config.katex_autorender_path))
         # Automatic math rendering and custom CSS
         # https://github.com/KaTeX/KaTeX/blob/main/contrib/auto-render/README.md
-        write_katex_autorenderer_file(app, filename_autorenderer)
-        add_js(filename_autorenderer)
+        add_js(write_katex_autorenderer_file(app, filename_autorenderer))
     else:
         KaTeXServer.katex_path = app.config.katex_js_path
-    # sphinxcontrib.katex custom CSS
-    copy_file(app, filename_css)
-    add_css(filename_css)
+        KaTeXServer.threads = app.config.katex_prerender_threads
+        KaTeXServerPool.processes = app.config.katex_prerender_processes
+        if app.config.katex_prerender_transport not in (
+                'socket',
+                'tcp',
+                'stdio',
+        ):
+            raise ExtensionError(
+                'katex_prerender_transport must be "socket", "tcp" or "stdio"'
+            )
+        KaTeXServer.transport = app.config.katex_prerender_transport
+        KaTeXServer.compile_cache = None
+        if app.config.katex_prerender_compile_cache:
+            KaTeXServer.compile_cache = compile_cache_directory()
+        # Share a render server started with
+        # `python -m sphinxcontrib.katex daemon start`
+        KaTeXServer.address = (
+            app.config.katex_prerender_server
+            or os.environ.get(SERVER_ENVIRONMENT_VARIABLE)
+        )
+        # Render with the same options as the browser would
+        options = dict(KATEX_DEFAULT_OPTIONS)
+        options['output'] = app.config.katex_prerender_output
+        options.update(convert_katex_options(katex_rendering_options(app)))
+        KaTeXServer.option_set = KaTeXServer.add_option_set(options)
+        if app.config.katex_prerender_warm_start:
+            # Load nodejs and KaTeX while Sphinx reads the sources
+            KaTeXServer.warm_start()
+        KaTeXMemo.katex_memo = KaTeXMemo(MEMO_SIZE)
+        # Forget equations rendered with another version of KaTeX,
+        # env_get_outdated() lets Sphinx read all documents again
+        version = katex_library_hash()
+        app._katex_library_changed = (
+            getattr(app.env, 'katex_prerendered_version', None) != version
+        )
+        if app._katex_library_changed:
+            app.env.katex_prerendered = {}
+            app.env.katex_prerendered_version = version
+        # Only report documents read in this build
+        app.env.katex_stats = {}
+        if app.config.katex_prerender_cache:
+            KaTeXCache.katex_cache = KaTeXCache(
+                Path(app.doctreedir) / CACHE_DIRNAME,
+                app.config.katex_prerender_cache_size,
+            )
+    if not app.config.katex_dist_path:
+        # sphinxcontrib.katex custom CSS
+        add_css(copy_file(app, filename_css))
+
+
+def env_updated(app, env):
+    if app.config.katex_dist_path:
+        # Sphinx 1.8 renamed `add_stylesheet` to `add_css_file`
+        add_css = getattr(app, 'add_css_file', None)
+        if add_css is None:
+            add_css = app.add_stylesheet
+        used_classes = None
+        if prerendering(app) and app.config.katex_prune_fonts:
+            used_classes = katex_used_classes(prerendered_store(env))
+        add_css(copy_katex_css(app, used_classes))
+        # sphinxcontrib.katex custom CSS overrides KaTeX CSS
+        add_css(copy_file(app, filename_css))
+    # Remove files of earlier builds
+    prune_static_path(app)
 
 
 def builder_finished(app, exception):
-    # Delete temporary dir used for _static file
-    shutil.rmtree(app._katex_static_path)
+    memo = KaTeXMemo.katex_memo
+    if memo is not None:
+        logger.verbose(
+            'KaTeX render memo: %d hits, %d misses', memo.hits, memo.misses
+        )
+    # Keep the render cache below its configured size
+    if KaTeXCache.katex_cache is not None:
+        KaTeXCache.katex_cache.prune()
+    if collecting_stats(app):
+        report_stats(app)
+    if (
+        exception is None
+        and app.builder.format == 'html'
+        and app.config.katex_precompress_pages
+    ):
+        precompress_pages(app)
 
 
-def write_katex_autorenderer_file(app, filename):
-    filename = os.path.join(
-        app.builder.srcdir, app._katex_static_path, filename
+def report_stats(app):
+    """Log and store render statistics of all documents."""
+    stats = KaTeXStats(
+        slowest=app.config.katex_prerender_stats or STATS_SLOWEST,
     )
+    for docname, document_stats in sorted(prerender_stats(app.env).items()):
+        stats.merge(document_stats, docname)
+    if app.config.katex_prerender_stats:
+        for line in stats.report():
+            logger.info(line)
+    if app.config.katex_prerender_stats_file:
+        filename = os.path.join(
+            app.confdir,
+            app.config.katex_prerender_stats_file,
+        )
+        with open(filename, 'w') as file:
+            json.dump(stats.summary(), file, indent=2)
+
+
+def write_katex_autorenderer_file(app, filename):
     content = katex_autorenderer_content(app)
-    with open(filename, 'w') as file:
-        file.write(content)
+    return write_static_file(app, filename, content.encode('utf-8'))
 
 
 def copy_file(app, file_name):
-    r"""Copy file to statis path."""
+    r"""Copy file to static path and return its name there."""
     pwd = os.path.abspath(os.path.dirname(__file__))
     source = os.path.join(pwd, file_name)
-    dest = os.path.join(app._katex_static_path, file_name)
-    copyfile(source, dest)
+    with open(source, 'rb') as file:
+        content = file.read()
+    return write_static_file(app, os.path.basename(file_name), content)
+
+
+def static_file_name(app, file_name, content):
+    """Name of a static file, with a hash of its content if requested."""
+    if not app.config.katex_static_fingerprint:
+        return file_name
+    digest = hashlib.sha256(content).hexdigest()[:FINGERPRINT_LENGTH]
+    root, ext = os.path.splitext(file_name)
+    return '{}.{}{}'.format(root, digest, ext)
+
+
+def write_static_file(app, file_name, content, fingerprint=True):
+    """Write file to static path if its content changed.
+
+    Unchanged files keep their modification time,
+    so that Sphinx does not copy them to the output again.
+
+    Args:
+        app: Sphinx application
+        file_name: path of the file relative to the static path,
+            using ``/`` as separator
+        content: content of the file as bytes
+        fingerprint: if ``True`` and ``katex_static_fingerprint`` is set,
+            add a hash of the content to the file name
+
+    Returns:
+        name of the file in the static path
+
+    """
+    if fingerprint:
+        file_name = static_file_name(app, file_name, content)
+    dest = os.path.join(app._katex_static_path, *file_name.split('/'))
+    app._katex_static_files.add(file_name)
+    changed = True
+    if os.path.exists(dest):
+        with open(dest, 'rb') as file:
+            changed = file.read() != content
+    if changed:
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        with open(dest, 'wb') as file:
+            file.write(content)
+    precompress = (
+        app.config.katex_precompress
+        and os.path.splitext(file_name)[1] in PRECOMPRESS_EXTENSIONS
+    )
+    if changed or not precompress:
+        # Sphinx does not replace or remove outdated copies in the output
+        output = os.path.join(app.outdir, '_static', *file_name.split('/'))
+        remove_compressed_files(output)
+    if precompress:
+        for ext in write_compressed_files(dest, content, changed):
+            app._katex_static_files.add(file_name + ext)
+    return file_name
+
+
+def compressors():
+    """Compress functions by file extension of the compressed files.
+
+    Brotli is only used if the ``brotli`` package is installed.
+
+    """
+    functions = {
+        # Without time stamp unchanged content gives identical files
+        '.gz': lambda content: gzip.compress(content, 9, mtime=0),
+    }
+    if brotli is not None:
+        functions['.br'] = brotli.compress
+    return functions
+
+
+def write_compressed_files(path, content, changed=True):
+    """Write compressed copies next to a file.
+
+    Web servers like nginx can serve them
+    instead of compressing the file on every request.
+
+    Args:
+        path: path of the file
+        content: content of the file as bytes
+        changed: if ``False``,
+            only compressed copies that do not exist yet are written
+
+    Returns:
+        file extensions of the compressed copies
+
+    """
+    extensions = []
+    for ext, compress in compressors().items():
+        if changed or not os.path.exists(path + ext):
+            with open(path + ext, 'wb') as file:
+                file.write(compress(content))
+        extensions.append(ext)
+    return extensions
+
+
+def remove_compressed_files(path):
+    """Remove compressed copies next to a file."""
+    for ext in COMPRESSED_EXTENSIONS:
+        if os.path.exists(path + ext):
+            os.remove(path + ext)
+
+
+def precompress_pages(app):
+    """Write compressed copies of pages with many pre-rendered equations.
+
+    Pages are only compressed again if they were written again.
+    Compressed copies of pages having too few equations are removed,
+    so that web servers do not serve outdated copies.
+
+    """
+    store = prerendered_store(app.env)
+    for docname in app.env.found_docs:
+        # Newer Sphinx versions return a path object
+        path = os.fspath(app.builder.get_outfilename(docname))
+        if not os.path.exists(path):
+            continue
+        if len(store.get(docname, {})) < app.config.katex_precompress_pages:
+            remove_compressed_files(path)
+            continue
+        compressed = [path + ext for ext in compressors()]
+        changed = any(
+            not os.path.exists(compressed_path)
+            or os.path.getmtime(compressed_path) < os.path.getmtime(path)
+            for compressed_path in compressed
+        )
+        if changed:
+            with open(path, 'rb') as file:
+                write_compressed_files(path, file.read())
+
+
+def prune_static_path(app):
+    """Remove files not written by the current build.
+
+    Sphinx never removes files from the static folder of the output,
+    so their copies are removed there as well.
+
+    """
+    output_path = os.path.join(app.outdir, '_static')
+    for root, _dirs, files in os.walk(app._katex_static_path):
+        for file_name in files:
+            path = os.path.join(root, file_name)
+            name = os.path.relpath(path, app._katex_static_path)
+            name = name.replace(os.sep, '/')
+            if name not in app._katex_static_files:
+                os.remove(path)
+                output_file = os.path.join(output_path, *name.split('/'))
+                if os.path.exists(output_file):
+                    os.remove(output_file)
+
+
+def katex_used_classes(store):
+    """CSS classes used by pre-rendered equations."""
+    classes = set()
+    for equations in store.values():
+        for html in equations.values():
+            for match in CLASS_ATTRIBUTE_PATTERN.finditer(html):
+                classes.update(match.group(1).split())
+    return classes
+
+
+def katex_used_fonts(css, used_classes):
+    """Font families of the CSS rules matching the used classes.
+
+    A rule matches if all classes
+    of one of its selectors are used.
+
+    """
+    css = FONT_FACE_PATTERN.sub('', css)
+    fonts = set()
+    for rule in CSS_RULE_PATTERN.finditer(css):
+        selectors, declarations = rule.groups()
+        families = FONT_FAMILY_PATTERN.findall(declarations)
+        if not families:
+            continue
+        for selector in selectors.split(','):
+            if set(CSS_CLASS_PATTERN.findall(selector)) <= used_classes:
+                fonts.update(families)
+                break
+    return fonts
+
+
+def trim_katex_css(css, used_classes):
+    """Remove fonts not needed for the used classes from KaTeX CSS.
+
+    Font faces of unused font families are removed
+    and the remaining font faces are only loaded as WOFF2.
+
+    """
+    fonts = katex_used_fonts(css, used_classes)
+
+    def trim_font_face(match):
+        font_face = match.group(0)
+        families = FONT_FAMILY_PATTERN.findall(font_face)
+        if families and families[0] not in fonts:
+            return ''
+        for url, font_format in FONT_URL_PATTERN.findall(font_face):
+            if font_format == 'woff2':
+                return FONT_SRC_PATTERN.sub(
+                    'src:url({}) format("woff2")'.format(url),
+                    font_face,
+                )
+        return font_face
+
+    return FONT_FACE_PATTERN.sub(trim_font_face, css)
+
+
+def copy_katex_css(app, used_classes=None):
+    """Copy KaTeX CSS and its fonts from the KaTeX distribution.
+
+    Args:
+        app: Sphinx application
+        used_classes: CSS classes used by the equations,
+            if given only the needed fonts are copied
+
+    Returns:
+        name of the CSS file in the static path
+
+    """
+    dist_path = os.path.join(app.confdir, app.config.katex_dist_path)
+    source = os.path.join(dist_path, 'katex.min.css')
+    if not os.path.exists(source):
+        raise ExtensionError(
+            'katex_dist_path does not contain katex.min.css: {}'.format(
+                dist_path
+            )
+        )
+    with open(source, encoding='utf-8') as file:
+        css = file.read()
+    if used_classes is not None:
+        css = trim_katex_css(css, used_classes)
+    # Fonts are referenced relative to the CSS file
+    for url in CSS_URL_PATTERN.findall(css):
+        url = url.strip('\'"')
+        if '://' in url or url.startswith(('data:', '/', '..')):
+            continue
+        with open(os.path.join(dist_path, *url.split('/')), 'rb') as file:
+            write_static_file(app, url, file.read(), fingerprint=False)
+    return write_static_file(app, 'katex.min.css', css.encode('utf-8'))
 
 
 def katex_autorenderer_content(app):
@@ -219,11 +928,115 @@ def katex_autorenderer_content(app):
           renderMathInElement(document.body, katex_options);
         });
         ''')
+    selector = 'span.math, div.math'
+    render = dedent('''\
+        function katex_render_element(element) {
+          renderMathInElement(element, katex_options);
+        }
+        ''')
+    if app.config.katex_targeted_render:
+        content = dedent('''\
+            document.addEventListener("DOMContentLoaded", function() {
+              document.querySelectorAll("[data-katex]")
+                .forEach(katex_render_element);
+            });
+            ''')
+        selector = '[data-katex]'
+        render = katex_targeted_renderer_content()
+    if app.config.katex_lazy_render:
+        content = katex_lazy_renderer_content(app, selector)
     prefix = 'katex_options = {'
     suffix = '}'
     options = katex_rendering_options(app)
-    delimiters = katex_rendering_delimiters(app)
-    return '\n'.join([prefix, options, delimiters, suffix, content])
+    delimiters = ''
+    if not app.config.katex_targeted_render:
+        # Only the auto-renderer searches for delimiters
+        delimiters = katex_rendering_delimiters(app)
+    return '\n'.join([prefix, options, delimiters, suffix, render, content])
+
+
+def katex_targeted_renderer_content():
+    """Render the LaTeX of elements marked by the visitors.
+
+    The visitors store the LaTeX of an equation
+    as text of an element with a ``data-katex`` attribute,
+    which is ``"inline"`` or ``"display"``.
+    Other text of the page is not searched for delimiters.
+
+    """
+    return dedent('''\
+        function katex_render_element(element) {
+          var options = Object.assign({}, katex_options);
+          var mode = element.getAttribute("data-katex");
+          options.displayMode = mode == "display";
+          try {
+            katex.render(element.textContent, element, options);
+          } catch (error) {
+            // Keep the LaTeX of equations that cannot be rendered
+            console.error(error);
+          }
+        }
+        ''')
+
+
+def katex_lazy_renderer_content(app, selector):
+    """Render math near the viewport first and the rest when idle.
+
+    Math elements entering the viewport are rendered immediately,
+    all other math elements are rendered in chunks
+    taking at most ``katex_lazy_render_budget`` milliseconds
+    whenever the browser is idle.
+
+    """
+    variables = dedent('''\
+        katex_lazy_render_budget = {};
+        katex_lazy_render_selector = {};
+        ''').format(
+        float(app.config.katex_lazy_render_budget),
+        json.dumps(selector),
+    )
+    content = dedent('''\
+        document.addEventListener("DOMContentLoaded", function() {
+          var pending = new Set(
+            document.querySelectorAll(katex_lazy_render_selector)
+          );
+          if (!("IntersectionObserver" in window)) {
+            pending.forEach(katex_render_element);
+            return;
+          }
+          function render(element) {
+            if (pending.delete(element)) {
+              observer.unobserve(element);
+              katex_render_element(element);
+            }
+          }
+          var observer = new IntersectionObserver(function(entries) {
+            entries.forEach(function(entry) {
+              if (entry.isIntersecting) {
+                render(entry.target);
+              }
+            });
+          }, { rootMargin: "100% 0px" });
+          pending.forEach(function(element) {
+            observer.observe(element);
+          });
+          var whenIdle = window.requestIdleCallback || function(callback) {
+            return setTimeout(callback, 1);
+          };
+          function renderChunk() {
+            var start = performance.now();
+            while (pending.size > 0
+                   && performance.now() - start < katex_lazy_render_budget) {
+              render(pending.values().next().value);
+            }
+            if (pending.size > 0) {
+              whenIdle(renderChunk);
+            }
+          }
+          whenIdle(renderChunk);
+        });
+        ''')
+    return '\n'.join([variables, content])
 
 
 def katex_rendering_delimiters(app):
@@ -259,13 +1072,63 @@ def katex_rendering_options(app):
     return options
 
 
+def convert_katex_options(options_js):
+    """Convert KaTeX options from Javascript to a dictionary.
+
+    Render servers only accept options as JSON
+    and never evaluate code sent by their clients.
+    ``katex_options`` of ``conf.py``
+    is therefore evaluated by a separate nodejs process.
+    Options that have no JSON representation,
+    like functions, are dropped.
+
+    Args:
+        options_js: KaTeX options as body of a Javascript object,
+            e.g. as returned by :func:`katex_rendering_options`
+
+    Returns:
+        dictionary of KaTeX options
+
+    Raises:
+        KaTeXError: if the options are invalid
+
+    """
+    if not options_js:
+        return {}
+    cmd = [NODEJS_BINARY, SCRIPT_PATH, "--convert-options"]
+    try:
+        process = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    except OSError as e:
+        raise KaTeXError("Could not start nodejs: {}".format(e))
+    try:
+        stdout, stderr = process.communicate(
+            options_js.encode("utf-8"),
+            timeout=STARTUP_TIMEOUT,
+        )
+    except TimeoutExpired:
+        process.kill()
+        process.communicate()
+        raise KaTeXError("Converting katex_options is taking too long")
+    if process.returncode != 0:
+        raise KaTeXError(
+            "Invalid katex_options: {}".format(
+                stderr.decode("utf-8", "replace").strip()
+            )
+        )
+    return json.loads(stdout.decode("utf-8"))
+
+
 def trim(text):
     """Remove whitespace from both sides of a string."""
     return text.lstrip().rstrip()
 
 
 def setup_static_path(app):
-    app._katex_static_path = mkdtemp()
+    # Keep the files between builds,
+    # so that only changed files are written again
+    app._katex_static_path = os.path.join(app.doctreedir, STATIC_DIRNAME)
+    app._katex_static_files = set()
+    os.makedirs(app._katex_static_path, exist_ok=True)
     if app._katex_static_path not in app.config.html_static_path:
         app.config.html_static_path.append(app._katex_static_path)
 
@@ -297,11 +1160,45 @@ def setup(app):
     app.add_config_value('katex_inline', [r'\(', r'\)'], 'html')
     app.add_config_value('katex_display', [r'\[', r'\]'], 'html')
     app.add_config_value('katex_options', '', 'html')
+    app.add_config_value('katex_static_fingerprint', False, 'html')
+    app.add_config_value('katex_precompress', False, 'html')
+    app.add_config_value('katex_precompress_pages', 0, 'html')
+    app.add_config_value('katex_dist_path', '', 'html')
+    app.add_config_value('katex_prune_fonts', True, 'html')
+    app.add_config_value('katex_targeted_render', False, 'html')
+    app.add_config_value('katex_lazy_render', False, 'html')
+    app.add_config_value('katex_lazy_render_budget', 10, 'html')
     app.add_config_value('katex_prerender', False, 'html')
+    app.add_config_value('katex_prerender_threads', 0, 'html')
+    app.add_config_value('katex_prerender_processes', 1, 'html')
+    app.add_config_value('katex_prerender_warm_start', False, 'html')
+    app.add_config_value('katex_prerender_compile_cache', True, 'html')
+    app.add_config_value('katex_prerender_transport', 'socket', 'html')
+    app.add_config_value('katex_prerender_server', '', 'html')
+    app.add_config_value('katex_prerender_cache', True, 'html')
+    app.add_config_value(
+        'katex_prerender_cache_size',
+        256 * 1024 * 1024,
+        'html',
+    )
+    app.add_config_value('katex_prerender_minify', False, 'html')
+    app.add_config_value('katex_prerender_output', 'htmlAndMathml', 'html')
+    app.add_config_value('katex_prerender_stats', 0, 'html')
+    app.add_config_value('katex_prerender_stats_file', '', 'html')
     app.connect('builder-inited', builder_inited)
+    app.connect('doctree-read', doctree_read)
+    app.connect('env-get-outdated', env_get_outdated)
+    app.connect('env-purge-doc', env_purge_doc)
+    app.connect('env-merge-info', env_merge_info)
+    app.connect('env-updated', env_updated)
+    app.connect('html-page-context', html_page_context)
     app.connect('build-finished', builder_finished)
 
-    return {'version': __version__, 'parallel_read_safe': True}
+    return {
+        'version': __version__,
+        'parallel_read_safe': True,
+        'parallel_write_safe': True,
+    }
 
 
 # This function is copied from Sphinx 1.8 as it is not available in Sphinx 1.6
@@ -334,18 +1231,50 @@ def socket_timeout(sock, timeout):
         sock.settimeout(original)
 
 
-def random_free_port():
-    """Select a random port on local host."""
-    with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as sock:
-        # reuse sockets
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+def parse_address(address):
+    """Address of a render server as announced by the server.
 
-        # choose port=0 for random port
-        sock.bind(("127.0.0.1", 0))
+    ``"PORT"`` or ``"HOST:PORT"`` are network sockets,
+    everything else is the path of a unix socket.
 
-        # return port
-        _, p = sock.getsockname()
-        return p
+    """
+    host, _, port = address.rpartition(":")
+    if port.isdigit():
+        return {"host": host or "127.0.0.1", "port": int(port)}
+    return {"socket": address}
+
+
+def format_address(address):
+    """Address of a render server as string."""
+    if "socket" in address:
+        return address["socket"]
+    return "{}:{}".format(address.get("host", "127.0.0.1"), address["port"])
+
+
+def open_connection(address, timeout):
+    """Connect to a render server.
+
+    Args:
+        address: dictionary as returned by :func:`parse_address`
+        timeout: time in seconds to wait for the connection
+
+    """
+    if "socket" in address:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        target = address["socket"]
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        target = (address.get("host", "127.0.0.1"), address["port"])
+    try:
+        with socket_timeout(sock, timeout):
+            sock.connect(target)
+    except socket.timeout:
+        sock.close()
+        raise KaTeXServer.timeout_error(timeout)
+    except OSError:
+        sock.close()
+        raise
+    return sock
 
 
 class KaTeXError(Exception):
@@ -353,18 +1282,132 @@ class KaTeXError(Exception):
     pass
 
 
+class PipeConnection:
+    """Socket-like connection to the stdin and stdout of a process.
+
+    Timeouts are only supported on POSIX systems,
+    as select() does not work with pipes on Windows.
+
+    Args:
+        process: :class:`subprocess.Popen` with unbuffered pipes
+
+    """
+
+    def __init__(self, process):
+        self.stdin = process.stdin
+        self.stdout = process.stdout
+        self.timeout = None
+
+    def gettimeout(self):
+        """Timeout of receiving in seconds."""
+        return self.timeout
+
+    def settimeout(self, timeout):
+        """Set timeout of receiving in seconds, ``None`` blocks."""
+        self.timeout = timeout
+
+    def sendall(self, data):
+        """Write all data to stdin of the process."""
+        with memoryview(data) as view:
+            while view:
+                view = view[self.stdin.write(view):]
+
+    def recv_into(self, buffer):
+        """Read available data from stdout of the process into buffer."""
+        if self.timeout is not None and os.name == "posix":
+            ready, _, _ = select.select([self.stdout], [], [], self.timeout)
+            if not ready:
+                raise socket.timeout()
+        return self.stdout.readinto(buffer)
+
+    def close(self):
+        """Close both pipes."""
+        self.stdin.close()
+        self.stdout.close()
+
+
 class KaTeXServer:
     """Manages and communicates with an instance of the render server."""
 
     LENGTH_STRUCT = struct.Struct("<i")
     """Message length for 32-bit little-endian integer."""
 
+    BINARY_VERSION = 1
+    """Version of the binary message format.
+
+    Binary messages start with this version,
+    JSON messages with ``{``.
+
+    """
+
+    REQUEST_STRUCT = struct.Struct("<BBHI")
+    """Binary request header.
+
+    Version, flags, length of JSON encoded options, and request ID.
+    The header is followed by the options and the UTF-8 encoded LaTeX.
+
+    """
+
+    RESPONSE_STRUCT = struct.Struct("<BBHII")
+    """Binary response header.
+
+    Version, status, reserved, request ID,
+    and time spent in ``katex.renderToString()`` in microseconds.
+    The header is followed by the UTF-8 encoded HTML or error message.
+
+    """
+
+    FLAG_DISPLAY_MODE = 1
+    """Request flag to render in display mode."""
+
+    STATUS_ERROR = 1
+    """Response status of a failed rendering."""
+
+    FLAG_OPTION_SET = 2
+    """Request flag marking the options as name of an option set."""
+
+    protocol = "binary"
+    """Message format for single equations, ``"binary"`` or ``"json"``."""
+
+    option_sets = {}
+    """Registrations of option sets by name."""
+
+    option_set = None
+    """Name of the option set used by :func:`render_latex`."""
+
     katex_path = None
     """Path to KaTeX javascript file."""
 
     katex_server = None
     """Global instance of KaTeX server."""
 
+    threads = 0
+    """Number of worker threads rendering inside the server."""
+
+    address = None
+    """Address of a running server to connect to instead of starting one.
+
+    See :func:`parse_address`.
+
+    """
+
+    compile_cache = None
+    """Directory to store the compiled KaTeX library in.
+
+    Servers started later load KaTeX faster
+    by reusing the compiled code.
+    ``None`` compiles KaTeX on every start.
+
+    """
+
+    transport = "socket"
+    """Connection to the server, ``"socket"``, ``"tcp"`` or ``"stdio"``.
+
+    ``"socket"`` uses a unix socket on POSIX systems
+    and a network socket otherwise.
+
+    """
+
     STOP_TIMEOUT = 0.1
     """Wait time for the server to stop in seconds."""
 
@@ -375,16 +1418,36 @@ class KaTeXServer:
         return KaTeXError(message)
 
     @classmethod
-    def build_command(cls, socket=None, port=None):
+    def katex_file(cls):
+        """Absolute path to the KaTeX Javascript library."""
+        katex_path = str(cls.katex_path or "katex.min.js")
+        if not os.path.isabs(katex_path):
+            katex_path = os.path.join(SRC_DIR, katex_path)
+        return os.path.abspath(katex_path)
+
+    @classmethod
+    def build_command(cls, socket=None, port=None, stdio=False):
         """KaTeX node build command."""
         cmd = [NODEJS_BINARY, SCRIPT_PATH]
 
+        if stdio:
+            cmd.append("--stdio")
+
         if socket is not None:
             cmd.extend(["--socket", str(socket)])
 
         if port is not None:
             cmd.extend(["--port", str(port)])
 
+        if cls.threads:
+            # Runaway renders are cancelled by restarting their worker
+            render_timeout = int(RENDER_TIMEOUT * 1000)
+            cmd.extend(["--threads", str(cls.threads)])
+            cmd.extend(["--render-timeout", str(render_timeout)])
+
+        if cls.compile_cache is not None:
+            cmd.extend(["--compile-cache", str(cls.compile_cache)])
+
         if cls.katex_path is not None:
             # KaTeX will be included inside katex-server.js
             # using `require()`,
@@ -409,164 +1472,1154 @@ class KaTeXServer:
         return cmd
 
     @classmethod
-    def start_server_process(cls, rundir, timeout):
-        """Start KaTeX server."""
-        socket_path = rundir / "katex.sock"
+    def add_option_set(cls, options=None):
+        """Add a set of KaTeX options shared by many requests.
 
-        # Start the server process
-        cmd = cls.build_command(socket=socket_path)
-        process = Popen(cmd, stdin=PIPE, stdout=PIPE, cwd=rundir)
+        The option set is registered once per connection
+        and requests refer to it by the returned name
+        in their ``"options"`` entry,
+        instead of sending all options with every request.
 
-        # Wait for the server to come up and create the socket.
-        startup_start = time.monotonic()
-        while not socket_path.is_socket():
-            time.sleep(ONE_MILLISECOND)
-            if time.monotonic() - startup_start > timeout:
-                raise cls.timeout_error(timeout)
+        Args:
+            options: dictionary of KaTeX options,
+                see :func:`convert_katex_options`
+                for options given as Javascript
 
-        # Connect to the server through a unix socket
-        try:
-            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-            remaining = startup_start + timeout - time.monotonic()
-            with socket_timeout(sock, remaining):
-                sock.connect(str(socket_path))
-        except socket.timeout:
-            raise cls.timeout_error(timeout)
+        Returns:
+            name of the option set
 
-        return process, sock
+        """
+        registration = {"katex_options": options or {}}
+        serialized = json.dumps(registration, sort_keys=True)
+        name = hashlib.sha256(serialized.encode("utf-8")).hexdigest()[:16]
+        cls.option_sets[name] = dict(registration, register=name)
+        return name
 
     @classmethod
-    def start_network_socket(cls, rundir, timeout):
-        """Start server on random free port."""
-        # Start the server on a random free port and connect to it.
-        # The port may become unavailable in between the check and usage.
-        host = "127.0.0.1"
-        port = random_free_port()
-
-        # Start the server process
-        cmd = cls.build_command(port=port)
-        process = Popen(cmd, stdin=PIPE, stdout=PIPE, cwd=rundir)
-
-        # Connect to the server through a network socket. We need to wait for
-        # the server to create the server socket. A nicer solution which would
-        # also side-step the race condition would be for the server to select
-        # the random port and then print it to stdout. Then python could
-        # select() on stdout to wait for the port/socket path without resorting
-        # to polling. However, select() is not supported for pipes on Windows.
-        startup_start = time.monotonic()
-        while True:
-            try:
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                remaining = startup_start + timeout - time.monotonic()
-                if remaining <= 0.0:
-                    raise cls.timeout_error(timeout)
-
-                with socket_timeout(sock, remaining):
-                    sock.connect((host, port))
+    def launch(cls):
+        """Start the server process without waiting for it.
+
+        The server loads KaTeX in the background
+        until :meth:`connect` is called.
+
+        """
+        if cls.transport == "stdio":
+            # No socket and hence no directory to hold it,
+            # the pipes are unbuffered to read partial messages
+            rundir = None
+            cmd = cls.build_command(stdio=True)
+            process = Popen(cmd, stdin=PIPE, stdout=PIPE, bufsize=0)
+        else:
+            rundir = Path(tempfile.mkdtemp(prefix="sphinxcontrib_katex"))
+            if os.name == "posix" and cls.transport != "tcp":
+                cmd = cls.build_command(socket=rundir / "katex.sock")
+            else:
+                # Non-unix systems (i.e. Windows) do not support unix
+                # domain sockets for IPC, so we use network sockets.
+                # Port 0 lets the server select a free port itself.
+                cmd = cls.build_command(port=0)
+            process = Popen(cmd, stdin=PIPE, stdout=PIPE, cwd=rundir)
+
+        server = KaTeXServer(rundir, process)
 
-                break
-            except ConnectionRefusedError:
-                # The server is not up yet. Try again.
-                time.sleep(ONE_MILLISECOND)
-            except socket.timeout:
-                raise cls.timeout_error(timeout)
+        # Clean up after ourselves when skphinx is done.
+        # I don't want to register signal handlers here.
+        atexit.register(KaTeXServer.terminate, server)
+        # Worker processes forked by `sphinx-build -j N`
+        # exit without running atexit handlers,
+        # but run the finalizers of multiprocessing
+        multiprocessing.util.Finalize(
+            server,
+            KaTeXServer.terminate,
+            args=(server,),
+            exitpriority=0,
+        )
 
-        return process, sock
+        return server
 
     @classmethod
     def start(cls):
-        """Start KaTeX server."""
-        rundir = Path(tempfile.mkdtemp(prefix="sphinxcontrib_katex"))
+        """Start KaTeX server.
 
-        if os.name == "posix":
-            process, sock = cls.start_server_process(rundir, STARTUP_TIMEOUT)
-        else:
-            # Non-unix systems (i.e. Windows) do not support unix
-            # domain sockets for IPC, so we use network sockets.
-            process, sock = cls.start_network_socket(rundir, STARTUP_TIMEOUT)
+        If :attr:`address` is set,
+        connect to the server running there instead.
 
-        server = KaTeXServer(rundir, process, sock)
+        """
+        if cls.address:
+            return cls.attach(cls.address)
+        server = cls.launch()
+        server.connect(STARTUP_TIMEOUT)
+        return server
 
-        # Clean up after ourselves when skphinx is done.
-        # I don't want to register signal handlers here.
-        atexit.register(KaTeXServer.terminate, server)
+    @classmethod
+    def attach(cls, address, timeout=STARTUP_TIMEOUT):
+        """Connect to a render server started by another process.
 
-        return server
+        The server keeps running
+        when the connection is closed.
+
+        Args:
+            address: address as understood by :func:`parse_address`
+            timeout: time in seconds to wait for the connection
+
+        """
+        try:
+            sock = open_connection(parse_address(address), timeout)
+        except OSError as e:
+            raise KaTeXError(
+                "Cannot connect to KaTeX server at {}: {}".format(address, e)
+            )
+        return KaTeXServer(None, None, sock)
+
+    @classmethod
+    def warm_start(cls):
+        """Start the render server in the background.
+
+        The server is connected to
+        when the first equation is rendered.
+
+        """
+        server = cls.katex_server
+        if cls.address:
+            # The server is already running
+            return
+        if server is None or server.pid != os.getpid():
+            cls.katex_server = cls.launch()
 
     @classmethod
     def get(cls):
-        """Get the current render server or start one."""
-        if cls.katex_server is None:
-            cls.katex_server = KaTeXServer.start()
+        """Get the current render server or start one.
+
+        Every process uses its own render server.
+        A server inherited from the parent of a forked process
+        is left to the parent
+        and a new one is started.
+
+        """
+        server = cls.katex_server
+        if server is not None and server.pid != os.getpid():
+            server.detach()
+            server = None
+        if server is None:
+            cls.katex_server = server = KaTeXServer.start()
+        elif server.sock is None:
+            server.connect(STARTUP_TIMEOUT)
 
-        return cls.katex_server
+        return server
 
-    def __init__(self, rundir, process, sock):
+    def __init__(self, rundir, process, sock=None):
         self.rundir = rundir
         self.process = process
         self.sock = sock
+        # Process owning the server and its connection
+        self.pid = os.getpid()
+        self.terminated = False
 
         # 100KB should be large enough even for big equations
         self.buffer = bytearray(100 * 1024)
 
+        # Responses are matched to their requests by 32-bit IDs
+        self.request_ids = itertools.cycle(range(1 << 32))
+
+        # Names of option sets registered on this connection
+        self.registered = set()
+
+        # Only one thread at a time may talk to the server
+        self.lock = threading.RLock()
+
+    def connect(self, timeout):
+        """Wait for the server to come up and connect to it.
+
+        The server announces the address it is listening on
+        with a single line on its stdout.
+        Servers using the stdio transport
+        read requests from stdin as soon as they are ready.
+
+        """
+        if self.rundir is None:
+            self.sock = PipeConnection(self.process)
+            return
+
+        address = self.wait_ready(timeout)
+        self.sock = open_connection(address, timeout)
+
+    def wait_ready(self, timeout):
+        """Read the address announced by the server."""
+        # select() is not supported for pipes on Windows,
+        # so we read the line in a separate thread
+        lines = []
+        reader = threading.Thread(
+            target=lambda: lines.append(self.process.stdout.readline()),
+            daemon=True,
+        )
+        reader.start()
+        reader.join(timeout)
+        if not lines:
+            raise self.timeout_error(timeout)
+        if not lines[0]:
+            raise KaTeXError(
+                "KaTeX server exited with code {}".format(self.process.wait())
+            )
+        return json.loads(lines[0])
+
+    def detach(self):
+        """Close the connection inherited by a forked process.
+
+        The server process, its connection and its temporary files
+        still belong to the parent process.
+
+        """
+        if self.sock is not None:
+            self.sock.close()
+        self.terminated = True
+
     def terminate(self):
         """Terminate the render server and clean up."""
-        self.sock.close()
+        # Only the process that started the server may stop it
+        if self.terminated or self.pid != os.getpid():
+            return
+        self.terminated = True
+        if self.sock is not None:
+            self.sock.close()
+        if self.process is None:
+            # Attached to a server owned by another process
+            return
         try:
             self.process.terminate()
             self.process.wait(timeout=self.STOP_TIMEOUT)
         except TimeoutExpired:
             self.process.kill()
-        shutil.rmtree(self.rundir)
+        if self.rundir is not None:
+            shutil.rmtree(self.rundir)
 
     def render(self, request, timeout=None):
-        """Render content."""
-        # Configure timeouts
-        if timeout is not None:
-            start_time = time.monotonic()
-            self.sock.settimeout(timeout)
+        """Render content.
+
+        The response contains the time in seconds
+        until it was received as ``"time"``
+        and the time the server spent rendering in microseconds
+        as ``"render_time"``.
+
+        """
+        with self.lock:
+            request = dict(request, id=next(self.request_ids))
+            deadline = None
+            if timeout is not None:
+                deadline = time.monotonic() + timeout
+
+            start = time.perf_counter()
+            self.send([request])
+            while True:
+                response = self.receive(deadline)
+                # Skip late responses to requests that have timed out before
+                if response.get("id", request["id"]) == request["id"]:
+                    response["time"] = time.perf_counter() - start
+                    return response
+
+    def library_hash(self, timeout=STARTUP_TIMEOUT):
+        """Hash of the KaTeX library the server renders with.
+
+        See :func:`katex_library_hash`.
+
+        """
+        try:
+            response = self.render({"library": True}, timeout)
+        except socket.timeout:
+            raise self.timeout_error(timeout)
+        if "library" not in response:
+            raise KaTeXError(
+                "KaTeX server did not report its library: {}".format(
+                    response.get("error", response)
+                )
+            )
+        return response["library"]
+
+    def render_iter(self, requests, timeout=None, window=PIPELINE_WINDOW):
+        """Render several requests without waiting for each response.
+
+        Up to ``window`` requests are sent
+        before waiting for the first response.
+        Responses are yielded as soon as they arrive,
+        which might not be the order of the requests.
+        Other threads cannot use the server
+        until the generator is exhausted or closed.
+        As for :meth:`render`,
+        responses contain ``"time"`` and ``"render_time"``.
+
+        Args:
+            requests: iterable of requests
+            timeout: time in seconds to wait for each response
+            window: maximum number of requests in flight
+
+        Yields:
+            tuple of index of the request and its response
+
+        """
+        with self.lock:
+            yield from self._render_iter(requests, timeout, window)
+
+    def _render_iter(self, requests, timeout, window):
+        requests = iter(requests)
+        in_flight = {}
+        sent_at = {}
+        index = 0
+        exhausted = False
+        while True:
+            # Fill the window before reading any response
+            batch = []
+            while not exhausted and len(in_flight) + len(batch) < window:
+                try:
+                    request = next(requests)
+                except StopIteration:
+                    exhausted = True
+                    break
+                request = dict(request, id=next(self.request_ids))
+                in_flight[request["id"]] = index
+                batch.append(request)
+                index += 1
+            if batch:
+                sent = time.perf_counter()
+                for request in batch:
+                    sent_at[request["id"]] = sent
+                self.send(batch)
+
+            if not in_flight:
+                return
+
+            deadline = None
+            if timeout is not None:
+                deadline = time.monotonic() + timeout
+            response = self.receive(deadline)
+            if "id" not in response:
+                # The server could not even decode the request
+                raise KaTeXError(response.get("error", "Unknown response"))
+            if response["id"] in in_flight:
+                sent = sent_at.pop(response["id"])
+                response["time"] = time.perf_counter() - sent
+                yield in_flight.pop(response["id"]), response
+
+    def send(self, requests):
+        """Send requests without waiting for the responses."""
+        # Write all requests at once
+        data = self.frame(requests)
+        self.sock.settimeout(None)
+        self.sock.sendall(data)
+
+    def frame(self, requests):
+        """Encode requests as length-prefixed messages."""
+        messages = []
+        for request in self.with_registrations(requests):
+            parts = self.encode(request)
+            length = sum(len(part) for part in parts)
+            messages.append(self.LENGTH_STRUCT.pack(length))
+            messages.extend(parts)
+        return b"".join(messages)
+
+    def with_registrations(self, requests):
+        """Precede requests by registrations of their option sets.
+
+        The server answers registrations with an ID
+        nobody is waiting for,
+        so their responses are skipped.
+
+        """
+        for request in requests:
+            names = [request.get("options")]
+            names += [item.get("options") for item in request.get("batch", [])]
+            for name in names:
+                if name is not None and name not in self.registered:
+                    self.registered.add(name)
+                    registration = self.option_sets[name]
+                    yield dict(registration, id=next(self.request_ids))
+            yield request
+
+    def encode(self, request):
+        """Encode a request as list of message parts.
+
+        Single equations are sent in the binary format
+        and everything else as JSON.
+
+        """
+        if self.protocol == "binary":
+            parts = self.encode_binary(request)
+            if parts is not None:
+                return parts
+        return [json.dumps(request).encode("utf-8")]
+
+    def encode_binary(self, request):
+        """Encode a request in the binary format if possible."""
+        if not set(request) <= {"latex", "katex_options", "options", "id"}:
+            return None
+
+        options = dict(request.get("katex_options") or {})
+        flags = 0
+        if options.pop("displayMode", False):
+            flags |= self.FLAG_DISPLAY_MODE
+        option_set = request.get("options")
+        if option_set is not None:
+            if options:
+                # Only displayMode can be combined with an option set
+                return None
+            flags |= self.FLAG_OPTION_SET
+            options_bytes = option_set.encode("utf-8")
+        elif options:
+            options_bytes = json.dumps(options).encode("utf-8")
         else:
-            self.sock.settimeout(None)
+            options_bytes = b""
+        if len(options_bytes) > 0xFFFF:
+            return None
+
+        header = self.REQUEST_STRUCT.pack(
+            self.BINARY_VERSION,
+            flags,
+            len(options_bytes),
+            request.get("id", 0),
+        )
+        return [header, options_bytes, request["latex"].encode("utf-8")]
 
-        # Send the request
-        request_bytes = json.dumps(request).encode("utf-8")
-        length = len(request_bytes)
-        self.sock.sendall(self.LENGTH_STRUCT.pack(length))
-        self.sock.sendall(request_bytes)
+    def receive(self, deadline=None):
+        """Receive the next response from the server.
 
-        # Read the amount of bytes we are about to receive
-        size = self.sock.recv(self.LENGTH_STRUCT.size)
-        length = self.LENGTH_STRUCT.unpack(size)[0]
+        Args:
+            deadline: value of :func:`time.monotonic`
+                after which :class:`socket.timeout` is raised
 
+        """
+        size = self.receive_into(self.LENGTH_STRUCT.size, deadline)
+        length = self.LENGTH_STRUCT.unpack(size)[0]
+        view = self.receive_into(length, deadline, partial=True)
+        # Decode the response directly from the receive buffer
+        return self.decode(view)
+
+    def decode(self, view):
+        """Decode a response message without its length."""
+        if len(view) > 0 and view[0] == self.BINARY_VERSION:
+            _, status, _, request_id, render_time = (
+                self.RESPONSE_STRUCT.unpack_from(view)
+            )
+            payload = str(view[self.RESPONSE_STRUCT.size:], "utf-8")
+            key = "error" if status == self.STATUS_ERROR else "html"
+            return {
+                key: payload,
+                "id": request_id,
+                "render_time": render_time,
+            }
+        return json.loads(str(view, "utf-8"))
+
+    def receive_into(self, length, deadline=None, partial=False):
+        """Read exactly ``length`` bytes into the buffer.
+
+        If the deadline expires in the middle of a message,
+        the rest of the message would be read as next message,
+        so the connection is closed
+        and the server cannot be used anymore.
+
+        Args:
+            length: number of bytes
+            deadline: value of :func:`time.monotonic`
+                after which :class:`socket.timeout` is raised
+            partial: ``True`` if other parts of the message
+                were already read
+
+        """
         # Ensure that the buffer is large enough
         if len(self.buffer) < length:
             self.buffer = bytearray(length)
 
-        with memoryview(self.buffer) as view:
-            # Keep reading from the socket until we have received all bytes
-            received = 0
-            remaining = length
-            while remaining > 0:
-                # Abort if we are not done yet but the timeout has expired
-                if timeout is not None:
-                    elapsed = time.monotonic() - start_time
-                    if elapsed >= timeout:
+        view = memoryview(self.buffer)[:length]
+        # Keep reading from the socket until we have received all bytes
+        received = 0
+        try:
+            while received < length:
+                # Subsequent recvs only get the remaining time instead
+                # of the whole timeout again
+                if deadline is None:
+                    self.sock.settimeout(None)
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0.0:
                         raise socket.timeout()
-                    else:
-                        # Subsequent recvs only get the remaining time instead
-                        # of the whole timeout again
-                        self.sock.settimeout(timeout - elapsed)
-
-                n_received = self.sock.recv_into(
-                    view[received:length],
-                    remaining,
-                )
+                    self.sock.settimeout(remaining)
+
+                n_received = self.sock.recv_into(view[received:])
+                if n_received == 0:
+                    raise KaTeXError("KaTeX server closed the connection")
                 received += n_received
-                remaining -= n_received
+        except socket.timeout:
+            if partial or received > 0:
+                self.abort()
+            raise
+
+        return view
 
-            # Decode the response
-            serialized = view[:length].tobytes().decode("utf-8")
-            return json.loads(serialized)
+    def abort(self):
+        """Stop using a connection that is out of sync."""
+        self.terminate()
+        if KaTeXServer.katex_server is self:
+            KaTeXServer.katex_server = None
+
+
+class KaTeXServerPool:
+    """Pool of render servers with a thread-safe client.
+
+    Each server runs in its own nodejs process.
+    Requests are dispatched to the next idle server,
+    so that several threads can render equations
+    using all available CPU cores.
+
+    Args:
+        servers: list of :class:`KaTeXServer`
+
+    """
+
+    processes = 1
+    """Number of render servers, 0 uses the number of CPUs."""
+
+    katex_server_pool = None
+    """Global instance of pool of KaTeX servers."""
+
+    @classmethod
+    def start(cls, processes=None):
+        """Start a pool of KaTeX servers."""
+        processes = processes or cls.processes or os.cpu_count() or 1
+        if KaTeXServer.address:
+            # Open several connections to the shared server
+            servers = [KaTeXServer.start() for _ in range(processes)]
+            return KaTeXServerPool(servers)
+        # Let all servers load KaTeX at the same time
+        servers = [KaTeXServer.launch() for _ in range(processes)]
+        for server in servers:
+            server.connect(STARTUP_TIMEOUT)
+        return KaTeXServerPool(servers)
+
+    @classmethod
+    def get(cls):
+        """Get the current pool of render servers or start one."""
+        pool = cls.katex_server_pool
+        if pool is not None and pool.pid != os.getpid():
+            # Forked processes must not share the servers of their parent
+            for server in pool.servers:
+                server.detach()
+            pool = None
+        elif pool is not None and any(s.terminated for s in pool.servers):
+            # A server was stopped after its connection got out of sync
+            pool.terminate()
+            pool = None
+        if pool is None:
+            cls.katex_server_pool = pool = KaTeXServerPool.start()
+
+        return pool
+
+    def __init__(self, servers):
+        self.servers = servers
+        self.pid = os.getpid()
+        self.idle = queue.Queue()
+        for server in servers:
+            self.idle.put(server)
+        self.executor = ThreadPoolExecutor(len(servers))
+
+    def terminate(self):
+        """Terminate all render servers."""
+        self.executor.shutdown()
+        for server in self.servers:
+            server.terminate()
+
+    @contextmanager
+    def server(self):
+        """Reserve an idle server for the calling thread."""
+        server = self.idle.get()
+        try:
+            yield server
+        finally:
+            self.idle.put(server)
+
+    def render(self, request, timeout=None):
+        """Render content on the next idle server."""
+        with self.server() as server:
+            return server.render(request, timeout)
+
+    def render_many(self, requests, timeout=None):
+        """Render several requests spread over all servers.
+
+        Args:
+            requests: list of requests
+            timeout: time in seconds to wait for each response
+
+        Returns:
+            list of responses in the order of the requests
+
+        """
+        requests = list(requests)
+        size = -(-len(requests) // len(self.servers))
+        chunks = [
+            requests[start:start + size]
+            for start in range(0, len(requests), size or 1)
+        ]
+        futures = [
+            self.executor.submit(self._render_chunk, chunk, timeout)
+            for chunk in chunks
+        ]
+        responses = []
+        for future in futures:
+            responses.extend(future.result())
+        return responses
+
+    def _render_chunk(self, requests, timeout):
+        responses = [None] * len(requests)
+        with self.server() as server:
+            for n, response in server.render_iter(requests, timeout):
+                responses[n] = response
+        return responses
+
+
+class AsyncKaTeXServer:
+    """Client of a render server for :mod:`asyncio` applications.
+
+    Requests of many tasks share a single connection
+    and are sent without waiting for earlier responses.
+    Responses are matched to their requests by ID,
+    so requests that time out or are cancelled
+    do not affect the other requests.
+
+    Use :meth:`start` to create a client.
+
+    Args:
+        server: :class:`KaTeXServer` owning the server process
+            and encoding the messages
+        reader: :class:`asyncio.StreamReader` of the connection
+        writer: :class:`asyncio.StreamWriter` of the connection
+        window: maximum number of requests in flight
+
+    """
+
+    def __init__(self, server, reader, writer, window=PIPELINE_WINDOW):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        # Futures of the requests in flight by request ID
+        self.pending = {}
+        # Backpressure: at most `window` requests are sent to the server
+        # and at most one task waits for the write buffer to drain
+        self.window = asyncio.Semaphore(window)
+        self.drain_lock = asyncio.Lock()
+        self.error = None
+        self.receiver = asyncio.ensure_future(self.receive())
+
+    @classmethod
+    async def start(cls, address=None, window=PIPELINE_WINDOW):
+        """Start a render server and connect to it.
+
+        Args:
+            address: address of a running server to connect to
+                instead of starting one,
+                see :func:`parse_address`.
+                Defaults to :attr:`KaTeXServer.address`
+            window: maximum number of requests in flight
+
+        Returns:
+            :class:`AsyncKaTeXServer`
+
+        Raises:
+            KaTeXError: if the server cannot be started or reached
+
+        """
+        loop = asyncio.get_running_loop()
+        address = address or KaTeXServer.address
+        if address:
+            server = KaTeXServer(None, None)
+            address = parse_address(address)
+        elif KaTeXServer.transport == "stdio":
+            raise KaTeXError(
+                "AsyncKaTeXServer needs the socket or tcp transport"
+            )
+        else:
+            server = KaTeXServer.launch()
+            try:
+                address = await loop.run_in_executor(
+                    None,
+                    server.wait_ready,
+                    STARTUP_TIMEOUT,
+                )
+            except KaTeXError:
+                server.terminate()
+                raise
+        try:
+            sock = await loop.run_in_executor(
+                None,
+                open_connection,
+                address,
+                STARTUP_TIMEOUT,
+            )
+        except OSError as e:
+            server.terminate()
+            raise KaTeXError(
+                "Cannot connect to KaTeX server at {}: {}".format(
+                    format_address(address),
+                    e,
+                )
+            )
+        reader, writer = await asyncio.open_connection(sock=sock)
+        return cls(server, reader, writer, window)
+
+    async def __aenter__(self):
+        """Use the client as asynchronous context manager."""
+        return self
+
+    async def __aexit__(self, *exc_info):
+        """Close the client at the end of the context."""
+        await self.close()
+
+    async def close(self):
+        """Close the connection and stop a server started by the client."""
+        self.receiver.cancel()
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (OSError, asyncio.CancelledError):
+            pass
+        self.fail(KaTeXError("KaTeX server connection is closed"))
+        self.server.terminate()
+
+    async def render(self, request, timeout=None):
+        """Render content.
+
+        As for :meth:`KaTeXServer.render`,
+        the response contains ``"time"`` and ``"render_time"``.
+
+        Args:
+            request: request as for :meth:`KaTeXServer.render`
+            timeout: time in seconds to wait for the response
+
+        Returns:
+            response of the server
+
+        Raises:
+            asyncio.TimeoutError: if the response did not arrive in time
+            KaTeXError: if the connection to the server is lost
+
+        """
+        async with self.window:
+            if self.error is not None:
+                raise self.error
+            request_id = next(self.server.request_ids)
+            future = asyncio.get_running_loop().create_future()
+            self.pending[request_id] = future
+            start = time.perf_counter()
+            try:
+                # The whole message is written at once,
+                # so messages of different tasks never interleave
+                self.writer.write(
+                    self.server.frame([dict(request, id=request_id)])
+                )
+                async with self.drain_lock:
+                    await self.writer.drain()
+                response = await asyncio.wait_for(future, timeout)
+            finally:
+                # Late responses are skipped by the receiver
+                self.pending.pop(request_id, None)
+        response["time"] = time.perf_counter() - start
+        return response
+
+    async def render_many(self, requests, timeout=None):
+        """Render several requests concurrently.
+
+        Args:
+            requests: iterable of requests
+            timeout: time in seconds to wait for each response
+
+        Returns:
+            list of responses in the order of the requests
+
+        """
+        return await asyncio.gather(
+            *[self.render(request, timeout) for request in requests]
+        )
+
+    async def receive(self):
+        """Pass responses to the tasks waiting for them."""
+        size = self.server.LENGTH_STRUCT.size
+        try:
+            while True:
+                header = await self.reader.readexactly(size)
+                length = self.server.LENGTH_STRUCT.unpack(header)[0]
+                response = self.server.decode(
+                    await self.reader.readexactly(length)
+                )
+                future = self.pending.get(response.get("id"))
+                if future is not None and not future.done():
+                    future.set_result(response)
+        except (asyncio.IncompleteReadError, OSError):
+            self.fail(KaTeXError("KaTeX server closed the connection"))
+        except Exception as e:
+            # Waiting requests must not hang after an invalid response,
+            # and the connection is out of sync
+            self.writer.close()
+            self.fail(
+                KaTeXError("Invalid response of KaTeX server: {}".format(e))
+            )
+
+    def fail(self, error):
+        """Fail all requests in flight and all later requests."""
+        if self.error is None:
+            self.error = error
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(self.error)
+
+
+class KaTeXMemo:
+    """Bounded in-process memo of rendered equations.
+
+    Identical equations are only rendered once per build
+    and afterwards looked up from memory.
+    The least recently used equations are discarded
+    when more than ``maxsize`` equations are stored.
+
+    Args:
+        maxsize: maximum number of stored equations
+
+    """
+
+    katex_memo = None
+    """Global instance of render memo."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def get_memo(cls):
+        """Get the current render memo or create one."""
+        if cls.katex_memo is None:
+            cls.katex_memo = KaTeXMemo(MEMO_SIZE)
+
+        return cls.katex_memo
+
+    @staticmethod
+    def key(latex, options):
+        """Memo key of an equation."""
+        return latex, json.dumps(options, sort_keys=True)
+
+    def get(self, key):
+        """Return memoized HTML or ``None``."""
+        try:
+            html = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return html
+
+    def put(self, key, html):
+        """Store rendered HTML."""
+        self.entries[key] = html
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+
+class KaTeXCache:
+    """Persistent, content-addressed cache of rendered equations.
+
+    Every rendered equation is stored in its own file,
+    named after the hash of the LaTeX source,
+    the KaTeX options,
+    and the KaTeX library used for rendering.
+    Files are written atomically,
+    so several Sphinx processes can share the same cache directory.
+
+    Args:
+        path: cache directory
+        max_size: maximum size of all cached files in bytes
+
+    """
+
+    katex_cache = None
+    """Global instance of render cache."""
+
+    def __init__(self, path, max_size):
+        self.path = Path(path)
+        self.max_size = max_size
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        # Rendering depends on the used KaTeX library
+        self.katex_hash = katex_library_hash()
+
+    def key(self, latex, options):
+        """Cache key of an equation."""
+        serialized = json.dumps(
+            [self.katex_hash, latex, options],
+            sort_keys=True,
+        )
+        return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+    def filename(self, key):
+        """Path to the cache file of a key."""
+        return self.path / key[:2] / key[2:]
+
+    def get(self, key):
+        """Return cached HTML or ``None``."""
+        filename = self.filename(key)
+        try:
+            with open(filename, encoding="utf-8") as file:
+                html = file.read()
+        except OSError:
+            return None
+        # Mark entry as recently used for eviction
+        try:
+            os.utime(filename)
+        except OSError:
+            pass
+        return html
+
+    def put(self, key, html):
+        """Store rendered HTML."""
+        filename = self.filename(key)
+        filename.parent.mkdir(exist_ok=True)
+        fd, tmpname = tempfile.mkstemp(dir=filename.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as file:
+                file.write(html)
+            os.replace(tmpname, filename)
+        except OSError:
+            # A failing cache should never fail the build
+            try:
+                os.remove(tmpname)
+            except OSError:
+                pass
+
+    def prune(self):
+        """Remove least recently used entries exceeding the maximum size."""
+        entries = []
+        total = 0
+        for filename in self.path.glob("*/*"):
+            try:
+                stat = filename.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, filename))
+            total += stat.st_size
+
+        entries.sort()
+        for _mtime, size, filename in entries:
+            if total <= self.max_size:
+                break
+            try:
+                filename.unlink()
+            except OSError:
+                pass
+            total -= size
+
+
+class KaTeXStats:
+    """Timing and size statistics of pre-rendered equations.
+
+    Collected per document by :func:`render_latex_batch`
+    and merged for the whole build.
+    The time of an equation is measured
+    from sending it to the server until receiving the result,
+    its render time is the time spent in ``katex.renderToString()``,
+    and the remaining time is spent in queues and in transit.
+
+    Args:
+        locations: source location of every equation
+            passed to :func:`render_latex_batch`
+        slowest: number of slowest equations to keep
+
+    """
+
+    PERCENTILES = (50, 90, 99)
+    """Percentiles of the equation times in reports."""
+
+    def __init__(self, locations=None, slowest=10):
+        self.locations = locations or []
+        self.slowest_count = slowest
+        self.equations = 0
+        self.rendered = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.html_bytes = 0
+        self.minified_bytes = 0
+        self.times = []
+        self.render_times = []
+        self.slowest = []
+        self.documents = {}
+
+    def add(self, index, latex, response):
+        """Add the response of the server for an equation."""
+        self.rendered += 1
+        self.bytes_in += len(latex.encode("utf-8"))
+        if "html" in response:
+            self.bytes_out += len(response["html"].encode("utf-8"))
+        else:
+            self.errors += 1
+        if "time" not in response:
+            return
+        render_time = response.get("render_time", 0) / 1e6
+        self.times.append(response["time"])
+        self.render_times.append(render_time)
+        location = None
+        if index < len(self.locations):
+            location = self.locations[index]
+        self.add_slowest([(response["time"], render_time, location, latex)])
+
+    def add_slowest(self, equations):
+        """Keep the slowest of the given and the listed equations."""
+        self.slowest = heapq.nlargest(
+            self.slowest_count,
+            self.slowest + equations,
+            key=lambda equation: equation[0],
+        )
+
+    def merge(self, other, docname=None):
+        """Add the statistics of ``other``, e.g. of a document."""
+        for name in [
+            "equations",
+            "rendered",
+            "errors",
+            "timeouts",
+            "bytes_in",
+            "bytes_out",
+            "html_bytes",
+            "minified_bytes",
+        ]:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        self.times.extend(other.times)
+        self.render_times.extend(other.render_times)
+        self.add_slowest(other.slowest)
+        if docname is not None:
+            self.documents[docname] = other.totals()
+
+    def totals(self):
+        """Counts and sizes of all equations."""
+        return {
+            "equations": self.equations,
+            "rendered": self.rendered,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "html_bytes": self.html_bytes,
+            "minified_bytes": self.minified_bytes,
+            "time": sum(self.times),
+            "render_time": sum(self.render_times),
+        }
+
+    @staticmethod
+    def percentile(values, percent):
+        """Nearest-rank percentile of ``values``."""
+        if not values:
+            return 0.0
+        values = sorted(values)
+        rank = max(1, -(-len(values) * percent // 100))
+        return values[rank - 1]
+
+    def summary(self):
+        """Statistics as dictionary that can be stored as JSON."""
+        summary = self.totals()
+        summary["queue_time"] = summary["time"] - summary["render_time"]
+        for name, values in [
+            ("time", self.times),
+            ("render_time", self.render_times),
+        ]:
+            summary[name + "_percentiles"] = {
+                str(percent): self.percentile(values, percent)
+                for percent in self.PERCENTILES
+            }
+            summary[name + "_percentiles"]["100"] = max(values, default=0.0)
+        summary["slowest"] = [
+            {
+                "time": duration,
+                "render_time": render_time,
+                "location": location,
+                "latex": latex,
+            }
+            for duration, render_time, location, latex in self.slowest
+        ]
+        summary["documents"] = self.documents
+        return summary
+
+    def report(self):
+        """Human readable summary as list of lines."""
+        summary = self.summary()
+        lines = [
+            "KaTeX: rendered {} of {} equations, "
+            "{} errors, {} timeouts, {} bytes in, {} bytes out".format(
+                self.rendered,
+                self.equations,
+                self.errors,
+                self.timeouts,
+                self.bytes_in,
+                self.bytes_out,
+            ),
+            "KaTeX: {:.2f} s waiting for equations, "
+            "{:.2f} s rendering, {:.2f} s queued or in transit".format(
+                summary["time"],
+                summary["render_time"],
+                summary["queue_time"],
+            ),
+        ]
+        if self.html_bytes:
+            lines.append(
+                "KaTeX: minified HTML of equations "
+                "from {} to {} bytes ({:.0%})".format(
+                    self.html_bytes,
+                    self.minified_bytes,
+                    self.minified_bytes / self.html_bytes,
+                )
+            )
+        for name in ["time", "render_time"]:
+            percentiles = ", ".join(
+                "p{} {:.1f} ms".format(percent, value * 1000)
+                for percent, value in summary[name + "_percentiles"].items()
+            )
+            lines.append(
+                "KaTeX: {} per equation {}".format(
+                    name.replace("_", " "),
+                    percentiles,
+                )
+            )
+        if self.slowest:
+            lines.append("KaTeX: slowest equations")
+        for duration, render_time, location, latex in self.slowest:
+            latex = " ".join(latex.split())
+            if len(latex) > 60:
+                latex = latex[:57] + "..."
+            lines.append(
+                "  {:.1f} ms (render {:.1f} ms) {}: {}".format(
+                    duration * 1000,
+                    render_time * 1000,
+                    location,
+                    latex,
+                )
+            )
+        return lines
+
+
+def katex_library_hash():
+    """Hash identifying the KaTeX library used for pre-rendering.
+
+    A render server given by :attr:`KaTeXServer.address`
+    might have been started with another library,
+    so it is asked for the hash of its library.
+
+    """
+    if KaTeXServer.address:
+        server = KaTeXServer.attach(KaTeXServer.address)
+        try:
+            return server.library_hash()
+        finally:
+            server.terminate()
+    katex_file = KaTeXServer.katex_file()
+    if not os.path.exists(katex_file):
+        return hashlib.sha256(katex_version.encode("utf-8")).hexdigest()
+    with open(katex_file, "rb") as file:
+        return hashlib.sha256(file.read()).hexdigest()
 
 
 def render_latex(latex, options=None):
@@ -579,23 +2632,625 @@ def render_latex(latex, options=None):
     options : optional dict
         KaTeX options such as displayMode
     """
-    # Combine caller-defined options with the default options
-    katex_options = KATEX_DEFAULT_OPTIONS
-    if options is not None:
-        katex_options = katex_options.copy()
-        katex_options.update(options)
+    html = render_latex_batch([(latex, options)])[0]
+    if isinstance(html, KaTeXError):
+        raise html
+    return html
+
+
+def render_latex_batch(equations, store=None, stats=None):
+    """Ask the KaTeX server to render several equations at once.
+
+    Equations already rendered during the build
+    or stored in the render cache
+    are not sent to the server again.
+    All remaining equations are sent together,
+    as pipelined binary messages
+    or as a single JSON message.
+
+    Args:
+        equations: list of ``(latex, options)`` pairs
+            as expected by :func:`render_latex`
+        store: rendered equations of a document,
+            used before all other caches
+            and updated with the results
+        stats: :class:`KaTeXStats` updated with all rendered equations
+
+    Returns:
+        list of the rendered HTML of every equation,
+        or a :class:`KaTeXError` if an equation could not be rendered
 
-    server = KaTeXServer.get()
-    request = {"latex": latex, "katex_options": katex_options}
+    """
+    memo = KaTeXMemo.get_memo()
+    cache = KaTeXCache.katex_cache
+    option_set = KaTeXServer.option_set
+
+    results = [None] * len(equations)
+    # Equations that need to be rendered by the server,
+    # identical equations are only sent once
+    pending = OrderedDict()
+    for n, (latex, options) in enumerate(equations):
+        if option_set is None:
+            # Combine caller-defined options with the default options
+            katex_options = KATEX_DEFAULT_OPTIONS
+            if options is not None:
+                katex_options = katex_options.copy()
+                katex_options.update(options)
+            request = {"latex": latex, "katex_options": katex_options}
+        else:
+            # Inline math must not inherit displayMode from the option set
+            katex_options = {"displayMode": False}
+            if options is not None:
+                katex_options.update(options)
+            request = {
+                "latex": latex,
+                "katex_options": katex_options,
+                "options": option_set,
+            }
+
+        memo_key = memo.key(latex, [option_set, katex_options])
+        html = None
+        if store is not None:
+            html = store.get(memo_key)
+        if html is None:
+            html = memo.get(memo_key)
+            if html is not None and store is not None:
+                store[memo_key] = html
+        cache_key = None
+        if html is None and memo_key not in pending and cache is not None:
+            cache_key = cache.key(latex, [option_set, katex_options])
+            html = cache.get(cache_key)
+            if html is not None:
+                memo.put(memo_key, html)
+                if store is not None:
+                    store[memo_key] = html
+
+        if html is not None:
+            results[n] = html
+        elif memo_key in pending:
+            pending[memo_key][2].append(n)
+        else:
+            pending[memo_key] = (request, cache_key, [n])
+
+    if stats is not None:
+        stats.equations += len(equations)
+    if not pending:
+        return results
 
+    requests = [request for request, _, _ in pending.values()]
+    timeout = RENDER_TIMEOUT + RESTART_TIMEOUT
     try:
-        response = server.render(request, RENDER_TIMEOUT)
+        if KaTeXServerPool.processes != 1 and len(requests) > 1:
+            pool = KaTeXServerPool.get()
+            responses = pool.render_many(requests, timeout)
+        elif len(requests) == 1:
+            server = KaTeXServer.get()
+            responses = [server.render(requests[0], timeout)]
+        elif KaTeXServer.protocol == "binary":
+            # Pipelined binary messages, each with its own deadline
+            server = KaTeXServer.get()
+            responses = [None] * len(requests)
+            for n, response in server.render_iter(requests, timeout):
+                responses[n] = response
+        else:
+            server = KaTeXServer.get()
+            # A hung server must not stall a large document for hours
+            timeout = min(timeout * len(requests), BATCH_TIMEOUT)
+            response = server.render({"batch": requests}, timeout)
+            responses = response["batch"]
+            # All equations of a batch arrive together
+            for item in responses:
+                item["time"] = response["time"]
+    except socket.timeout:
+        if stats is not None:
+            stats.timeouts += len(requests)
+        if len(requests) == 1:
+            equation = requests[0]["latex"]
+        else:
+            equation = "{} equations".format(len(requests))
+        raise KaTeXError(TIMEOUT_EXPIRED_TEMPLATE.format(equation))
 
+    for (memo_key, (request, cache_key, indices)), response in zip(
+            pending.items(),
+            responses,
+    ):
+        if stats is not None:
+            stats.add(indices[0], request["latex"], response)
         if "html" in response:
-            return response["html"]
+            result = response["html"]
+            memo.put(memo_key, result)
+            if store is not None:
+                store[memo_key] = result
+            if cache_key is not None:
+                cache.put(cache_key, result)
         elif "error" in response:
-            raise KaTeXError(response["error"])
+            result = KaTeXError(response["error"])
         else:
-            raise KaTeXError("Unknown response from KaTeX renderer")
-    except socket.timeout:
-        raise KaTeXError(TIMEOUT_EXPIRED_TEMPLATE.format(latex))
+            result = KaTeXError("Unknown response from KaTeX renderer")
+        for n in indices:
+            results[n] = result
+
+    return results
+
+
+def compile_cache_directory():
+    """Directory storing the compiled KaTeX library.
+
+    nodejs executes the stored code,
+    so the directory is placed in the cache directory of the user
+    and must not be accessible by other users.
+
+    Returns:
+        path of the directory
+        or ``None`` if no private directory is available
+
+    """
+    if os.name == "nt":
+        root = os.environ.get("LOCALAPPDATA") or tempfile.gettempdir()
+    else:
+        root = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+            os.path.expanduser("~"), ".cache"
+        )
+    path = Path(root) / "sphinxcontrib_katex" / "compile_cache"
+    try:
+        return private_directory(path)
+    except (KaTeXError, OSError) as error:
+        # Not a warning, as the cache is optional
+        # and builds with `-W` must not fail
+        logger.info("Not caching the compiled KaTeX library: %s", error)
+        return None
+
+
+def private_directory(path):
+    """Create a directory only accessible by the current user.
+
+    An existing directory is only accepted
+    if it is owned by the current user
+    and cannot be accessed by other users,
+    who could otherwise place files in it.
+
+    Args:
+        path: path of the directory
+
+    Returns:
+        path of the directory
+
+    Raises:
+        KaTeXError: if the directory can be accessed by other users
+
+    """
+    path = Path(path)
+    try:
+        path.mkdir(mode=0o700, parents=True)
+    except FileExistsError:
+        pass
+    if hasattr(os, "getuid"):
+        info = path.lstat()
+        if (
+            path.is_symlink()
+            or not path.is_dir()
+            or info.st_uid != os.getuid()
+            or info.st_mode & 0o077
+        ):
+            raise KaTeXError(
+                "{} must be a directory owned by the current user "
+                "and not accessible by other users".format(path)
+            )
+    return path
+
+
+def daemon_directory():
+    """Default directory holding the state of the render daemon."""
+    name = "sphinxcontrib_katex_daemon"
+    if hasattr(os, "getuid"):
+        # The temporary directory might be shared with other users
+        name += "_{}".format(os.getuid())
+    return Path(tempfile.gettempdir()) / name
+
+
+def daemon_state(rundir):
+    """Process ID and address of the render daemon or ``None``."""
+    rundir = Path(rundir)
+    if not rundir.exists():
+        return None
+    # Do not trust a state written by other users
+    private_directory(rundir)
+    try:
+        with open(rundir / "daemon.json") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def daemon_running(state):
+    """Check if the render daemon accepts connections."""
+    if state is None:
+        return False
+    try:
+        KaTeXServer.attach(state["address"], timeout=1.0).terminate()
+    except KaTeXError:
+        return False
+    return True
+
+
+def daemon_process(pid):
+    """Check if a process is a render daemon of the current user.
+
+    The process ID of a stopped daemon
+    might have been reused by another process.
+
+    """
+    if os.name != "posix":
+        # The temporary directory holding the state belongs to the user
+        return True
+    try:
+        with open("/proc/{}/cmdline".format(pid), "rb") as file:
+            args = file.read().decode("utf-8", "replace").split("\0")
+    except OSError:
+        # Systems without /proc
+        try:
+            output = Popen(
+                ["ps", "-o", "args=", "-p", str(pid)],
+                stdout=PIPE,
+                stderr=DEVNULL,
+            ).communicate()[0]
+        except OSError:
+            return False
+        args = output.decode("utf-8", "replace").split()
+        return SCRIPT_PATH in " ".join(args) and "--daemon" in args
+    return SCRIPT_PATH in args and "--daemon" in args
+
+
+def daemon_start(args):
+    rundir = private_directory(args.rundir)
+    state = daemon_state(rundir)
+    if daemon_running(state):
+        print(state["address"])
+        return 0
+
+    if args.katex is not None:
+        KaTeXServer.katex_path = os.path.abspath(args.katex)
+    KaTeXServer.threads = args.threads
+    KaTeXServer.compile_cache = compile_cache_directory()
+    if args.port is not None or os.name != "posix":
+        cmd = KaTeXServer.build_command(port=args.port or 0)
+    else:
+        socket_path = rundir / "katex.sock"
+        # Left behind by a daemon that was killed
+        if socket_path.exists():
+            socket_path.unlink()
+        cmd = KaTeXServer.build_command(socket=socket_path)
+    cmd.append("--daemon")
+
+    with open(rundir / "daemon.log", "ab") as log:
+        process = Popen(
+            cmd,
+            stdin=DEVNULL,
+            stdout=PIPE,
+            stderr=log,
+            cwd=rundir,
+            # Do not stop the daemon with the terminal it was started from
+            start_new_session=True,
+        )
+    address = KaTeXServer(rundir, process).wait_ready(STARTUP_TIMEOUT)
+    state = {"pid": process.pid, "address": format_address(address)}
+    with open(rundir / "daemon.json", "w") as file:
+        json.dump(state, file)
+    print(state["address"])
+    return 0
+
+
+def daemon_stop(args):
+    rundir = Path(args.rundir)
+    state = daemon_state(rundir)
+    if state is None:
+        print("KaTeX daemon is not running")
+        return 1
+    (rundir / "daemon.json").unlink()
+    if not daemon_process(state["pid"]):
+        print("KaTeX daemon is not running")
+        return 1
+    try:
+        os.kill(state["pid"], signal.SIGTERM)
+    except OSError:
+        # Already stopped
+        pass
+    print("KaTeX daemon stopped")
+    return 0
+
+
+def daemon_status(args):
+    state = daemon_state(args.rundir)
+    if not daemon_running(state):
+        print("KaTeX daemon is not running")
+        return 1
+    print(
+        "KaTeX daemon is running at {} with process ID {}".format(
+            state["address"],
+            state["pid"],
+        )
+    )
+    return 0
+
+
+def read_equations(files, input_format="auto", display=False):
+    """Read equations for :func:`render_command`.
+
+    Every line holds an equation,
+    either as LaTeX
+    or as JSON object with the entries
+    ``"latex"``,
+    and optionally ``"display"``, ``"options"`` and ``"id"``.
+
+    Yields:
+        tuple of ID, LaTeX and KaTeX options
+
+    """
+    for file in files:
+        for number, line in enumerate(file, start=1):
+            line = line.rstrip("\r\n")
+            if not line.strip():
+                continue
+            is_json = input_format == "jsonl" or (
+                input_format == "auto" and line.lstrip().startswith("{")
+            )
+            if not is_json:
+                yield None, line, {"displayMode": display}
+                continue
+            try:
+                equation = json.loads(line)
+                latex = equation["latex"]
+            except (ValueError, KeyError, TypeError):
+                raise KaTeXError(
+                    "Invalid equation in {}, line {}: {}".format(
+                        file.name,
+                        number,
+                        line,
+                    )
+                )
+            options = dict(equation.get("options") or {})
+            options["displayMode"] = equation.get("display", display)
+            yield equation.get("id"), latex, options
+
+
+def render_command(args):
+    """Render equations and write the results as JSON lines."""
+    if args.katex is not None:
+        KaTeXServer.katex_path = os.path.abspath(args.katex)
+    KaTeXServer.threads = args.threads
+    KaTeXServer.compile_cache = compile_cache_directory()
+    KaTeXServerPool.processes = args.processes
+    KaTeXServer.address = os.environ.get(SERVER_ENVIRONMENT_VARIABLE)
+    if args.options is not None:
+        KaTeXServer.option_set = KaTeXServer.add_option_set(
+            dict(KATEX_DEFAULT_OPTIONS, **json.loads(args.options))
+        )
+    files = []
+    try:
+        if args.cache is not None:
+            KaTeXCache.katex_cache = KaTeXCache(
+                Path(args.cache),
+                args.cache_size,
+            )
+        for name in args.files:
+            files.append(open(name, encoding="utf-8"))
+    except OSError as e:
+        for file in files:
+            file.close()
+        raise KaTeXError(str(e))
+    equations = read_equations(
+        files or [sys.stdin],
+        args.input_format,
+        args.display,
+    )
+    count = 0
+    errors = 0
+    start = time.perf_counter()
+    try:
+        # Render in chunks to stream results
+        # without keeping all equations in memory
+        while True:
+            chunk = list(itertools.islice(equations, args.chunk_size))
+            if not chunk:
+                break
+            results = render_latex_batch(
+                [(latex, options) for _id, latex, options in chunk]
+            )
+            for (equation_id, _latex, _options), html in zip(chunk, results):
+                if isinstance(html, KaTeXError):
+                    result = {"error": str(html)}
+                    errors += 1
+                else:
+                    result = {"html": html}
+                if equation_id is not None:
+                    result["id"] = equation_id
+                sys.stdout.write(json.dumps(result) + "\n")
+            sys.stdout.flush()
+            count += len(chunk)
+    finally:
+        for file in files:
+            file.close()
+    if KaTeXCache.katex_cache is not None:
+        KaTeXCache.katex_cache.prune()
+
+    duration = time.perf_counter() - start
+    sys.stderr.write(
+        "Rendered {} equations with {} errors in {:.2f} s, "
+        "{:.0f} equations/s\n".format(
+            count,
+            errors,
+            duration,
+            count / duration if duration > 0 else 0,
+        )
+    )
+    return 1 if errors else 0
+
+
+def warm_command(args):
+    """Read a Sphinx project to fill the render cache and environment.
+
+    All documents are read with pre-rendering enabled
+    and written to a temporary folder.
+    Later builds using the same doctree folder
+    only render equations that changed since.
+
+    """
+    from sphinx.cmd.build import build_main
+
+    with tempfile.TemporaryDirectory() as outdir:
+        argv = [
+            "-b",
+            "html",
+            "-q",
+            "-d",
+            args.doctreedir,
+            "-j",
+            str(args.jobs),
+            "-D",
+            "katex_prerender=1",
+        ]
+        if args.confdir is not None:
+            argv += ["-c", args.confdir]
+        return build_main(argv + [args.sourcedir, outdir])
+
+
+def main(argv=None):
+    """Command line interface of ``python -m sphinxcontrib.katex``."""
+    parser = argparse.ArgumentParser(
+        prog="python -m sphinxcontrib.katex",
+        description="Tools for pre-rendering math with KaTeX.",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    daemon = commands.add_parser(
+        "daemon",
+        help="manage a render server shared by several builds",
+        description=(
+            "Start, stop or check a render server running in the background. "
+            "Builds connect to it if its address is set in the "
+            "katex_prerender_server config value "
+            "or the {} environment variable.".format(
+                SERVER_ENVIRONMENT_VARIABLE
+            )
+        ),
+    )
+    daemon.add_argument("action", choices=["start", "stop", "status"])
+    daemon.add_argument(
+        "--rundir",
+        default=str(daemon_directory()),
+        help="directory holding the state of the daemon",
+    )
+    daemon.add_argument(
+        "--port",
+        type=int,
+        help="listen on this local network port instead of a unix socket",
+    )
+    daemon.add_argument(
+        "--threads",
+        type=int,
+        default=0,
+        help="number of worker threads rendering equations",
+    )
+    daemon.add_argument("--katex", help="path to katex.min.js")
+    daemon.set_defaults(
+        func=lambda args: {
+            "start": daemon_start,
+            "stop": daemon_stop,
+            "status": daemon_status,
+        }[args.action](args)
+    )
+
+    render = commands.add_parser(
+        "render",
+        help="render equations to JSON lines",
+        description=(
+            "Render equations given as lines of LaTeX "
+            "or as JSON lines with the entries "
+            '"latex", "display", "options" and "id". '
+            'Results are written as JSON lines with "html" or "error" '
+            'and the "id" of the equation, in the order of the equations.'
+        ),
+    )
+    render.add_argument(
+        "files",
+        nargs="*",
+        help="files with one equation per line (default: stdin)",
+    )
+    render.add_argument(
+        "--format",
+        dest="input_format",
+        choices=["auto", "jsonl", "lines"],
+        default="auto",
+        help="format of the equations, auto detects JSON lines",
+    )
+    render.add_argument(
+        "--display",
+        action="store_true",
+        help="render equations in display mode by default",
+    )
+    render.add_argument(
+        "--options",
+        help="KaTeX options for all equations as JSON object",
+    )
+    render.add_argument(
+        "--processes",
+        type=int,
+        default=1,
+        help="number of render servers, 0 starts one per CPU",
+    )
+    render.add_argument(
+        "--threads",
+        type=int,
+        default=0,
+        help="number of worker threads of every render server",
+    )
+    render.add_argument(
+        "--chunk-size",
+        type=int,
+        default=1000,
+        help="number of equations rendered together",
+    )
+    render.add_argument(
+        "--cache",
+        help="folder caching rendered equations between runs",
+    )
+    render.add_argument(
+        "--cache-size",
+        type=int,
+        default=256 * 1024 * 1024,
+        help="maximum size of the render cache in bytes",
+    )
+    render.add_argument("--katex", help="path to katex.min.js")
+    render.set_defaults(func=render_command)
+
+    warm = commands.add_parser(
+        "warm",
+        help="pre-render all math of a Sphinx project",
+        description=(
+            "Read a Sphinx project with pre-rendering enabled, "
+            "so that its equations are stored in the render cache "
+            "and the environment inside DOCTREEDIR. "
+            "Builds using the same DOCTREEDIR start with them."
+        ),
+    )
+    warm.add_argument("sourcedir", help="source folder of the project")
+    warm.add_argument("doctreedir", help="doctree folder of later builds")
+    warm.add_argument("-c", dest="confdir", help="folder containing conf.py")
+    warm.add_argument(
+        "-j",
+        dest="jobs",
+        default="1",
+        help="number of parallel processes, or auto",
+    )
+    warm.set_defaults(func=warm_command)
+
+    args = parser.parse_args(argv)
+    try:
+        return args.func(args)
+    except KaTeXError as e:
+        sys.stderr.write("{}\n".format(e))
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,48 @@
+import os
+
+from sphinxcontrib.katex import KaTeXCache
+from sphinxcontrib.katex import KaTeXMemo
+
+
+def test_katex_cache(tmp_path):
+    """Test storing and retrieving rendered equations."""
+    cache = KaTeXCache(tmp_path, max_size=1024)
+    key = cache.key(r"\omega", {"displayMode": True})
+    assert cache.get(key) is None
+    cache.put(key, "<span>ω</span>")
+    assert cache.get(key) == "<span>ω</span>"
+
+    # Keys depend on LaTeX and options
+    assert key == cache.key(r"\omega", {"displayMode": True})
+    assert key != cache.key(r"\omega", {"displayMode": False})
+    assert key != cache.key(r"\Omega", {"displayMode": True})
+
+
+def test_katex_cache_prune(tmp_path):
+    """Test eviction of least recently used entries."""
+    cache = KaTeXCache(tmp_path, max_size=250)
+    keys = [cache.key(str(n), {}) for n in range(3)]
+    for n, key in enumerate(keys):
+        cache.put(key, "x" * 100)
+        # Ensure distinct modification times
+        os.utime(cache.filename(key), (n, n))
+
+    cache.prune()
+    assert cache.get(keys[0]) is None
+    assert cache.get(keys[1]) is not None
+    assert cache.get(keys[2]) is not None
+
+
+def test_katex_memo():
+    """Test bounded memo of rendered equations."""
+    memo = KaTeXMemo(maxsize=2)
+    keys = [memo.key(latex, {}) for latex in ["a", "b", "c"]]
+    memo.put(keys[0], "A")
+    memo.put(keys[1], "B")
+    assert memo.get(keys[0]) == "A"
+    # Adding a third entry discards the least recently used one
+    memo.put(keys[2], "C")
+    assert memo.get(keys[1]) is None
+    assert memo.get(keys[0]) == "A"
+    assert memo.get(keys[2]) == "C"
+    assert (memo.hits, memo.misses) == (3, 1)
@@ -0,0 +1,124 @@
+import types
+
+from docutils import nodes
+import pytest
+
+from sphinxcontrib.katex import html_visit_displaymath
+from sphinxcontrib.katex import html_visit_math
+from sphinxcontrib.katex import katex_autorenderer_content
+
+
+def html_app(**config):
+    defaults = {
+        "katex_options": "",
+        "katex_inline": [r"\(", r"\)"],
+        "katex_display": [r"\[", r"\]"],
+        "katex_prerender": False,
+        "katex_targeted_render": False,
+        "katex_lazy_render": False,
+        "katex_lazy_render_budget": 10,
+    }
+    defaults.update(config)
+    return types.SimpleNamespace(config=types.SimpleNamespace(**defaults))
+
+
+class MathNode(dict):
+    """Math node of docutils with its LaTeX as text."""
+
+    def __init__(self, latex, **attributes):
+        super().__init__(attributes)
+        self.attributes = attributes
+        self.latex = latex
+
+    def astext(self):
+        return self.latex
+
+
+class Translator:
+    """HTML translator collecting the output of the visitors."""
+
+    def __init__(self, app):
+        self.builder = app
+        self.body = []
+
+    def starttag(self, node, tagname, suffix="\n", **attributes):
+        attributes = "".join(
+            f' {name.lower()}="{value}"'
+            for name, value in sorted(attributes.items())
+        )
+        return f"<{tagname}{attributes}>{suffix}"
+
+    def encode(self, text):
+        return text.replace("<", "&lt;")
+
+    def visit(self, visitor, node):
+        with pytest.raises(nodes.SkipNode):
+            visitor(self, node)
+        return "".join(self.body)
+
+
+def test_katex_autorenderer_content():
+    """Test rendering all math of a page when it is loaded."""
+    content = katex_autorenderer_content(html_app())
+    assert "renderMathInElement(document.body, katex_options);" in content
+    assert "IntersectionObserver" not in content
+
+
+def test_katex_lazy_renderer_content():
+    """Test rendering math when it gets visible or the browser is idle."""
+    content = katex_autorenderer_content(
+        html_app(katex_lazy_render=True, katex_lazy_render_budget=25)
+    )
+    assert "katex_lazy_render_budget = 25.0;" in content
+    assert 'katex_lazy_render_selector = "span.math, div.math";' in content
+    assert "new IntersectionObserver(" in content
+    assert "window.requestIdleCallback" in content
+    # Elements are rendered by the auto-renderer
+    assert "renderMathInElement(element, katex_options);" in content
+    assert "renderMathInElement(document.body" not in content
+
+
+def test_katex_targeted_renderer_content():
+    """Test rendering only the marked math elements."""
+    content = katex_autorenderer_content(html_app(katex_targeted_render=True))
+    assert 'document.querySelectorAll("[data-katex]")' in content
+    assert "katex.render(element.textContent, element, options);" in content
+    assert "renderMathInElement" not in content
+    assert "delimiters" not in content
+
+    content = katex_autorenderer_content(
+        html_app(
+            katex_targeted_render=True,
+            katex_lazy_render=True,
+            katex_lazy_render_budget=5,
+        )
+    )
+    assert 'katex_lazy_render_selector = "[data-katex]";' in content
+    assert "katex_lazy_render_budget = 5.0;" in content
+    assert "delimiters" not in content
+
+
+@pytest.mark.parametrize("targeted", [False, True])
+def test_html_visit_math(targeted):
+    """Test the markup of inline math."""
+    app = html_app(katex_targeted_render=targeted)
+    html = Translator(app).visit(html_visit_math, MathNode("a<b"))
+    if targeted:
+        assert html == '<span class="math" data-katex="inline">a&lt;b</span>'
+    else:
+        assert html == '<span class="math">\\(a&lt;b\\)</span>'
+
+
+@pytest.mark.parametrize("targeted", [False, True])
+def test_html_visit_displaymath(targeted):
+    """Test the markup of display math."""
+    app = html_app(katex_targeted_render=targeted)
+    node = MathNode("a<b", number=None, nowrap=False)
+    html = Translator(app).visit(html_visit_displaymath, node)
+    if targeted:
+        assert html == (
+            '<div class="math">\n'
+            '<span data-katex="display">a&lt;b</span></div>\n'
+        )
+    else:
+        assert html == '<div class="math">\n\\[a<b\\]</div>\n'
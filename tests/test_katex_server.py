@@ -1,12 +1,43 @@
+import asyncio
+import hashlib
+from html.parser import HTMLParser
+import json
 import os
+import shutil
+import socket
+import subprocess
+import sys
+import types
 
 import pytest
 
+from sphinxcontrib.katex import AsyncKaTeXServer
+from sphinxcontrib.katex import KaTeXCache
+from sphinxcontrib.katex import KaTeXError
 from sphinxcontrib.katex import KaTeXServer
+from sphinxcontrib.katex import KaTeXServerPool
+from sphinxcontrib.katex import KaTeXStats
+from sphinxcontrib.katex import compile_cache_directory
+from sphinxcontrib.katex import convert_katex_options
+from sphinxcontrib.katex import env_get_outdated
+from sphinxcontrib.katex import env_merge_info
+from sphinxcontrib.katex import env_purge_doc
+from sphinxcontrib.katex import katex_library_hash
+from sphinxcontrib.katex import main
+from sphinxcontrib.katex import minify_katex_html
+from sphinxcontrib.katex import private_directory
+from sphinxcontrib.katex import render_latex
+from sphinxcontrib.katex import render_latex_batch
+from sphinxcontrib.katex import writes_xhtml
 
 
 CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
 
+requires_node = pytest.mark.skipif(
+    shutil.which("node") is None,
+    reason="nodejs is not installed",
+)
+
 
 @pytest.mark.parametrize(
     "katex_js_path, expected_require_path",
@@ -65,3 +96,730 @@ def test_katex_server_js_path_error():
     with pytest.raises(ValueError, match=error_msg):
         KaTeXServer.katex_path = katex_js_path
         KaTeXServer.build_command()
+
+
+def fake_server(tmp_path):
+    """Server connected to a socket pair and a process doing nothing."""
+    rundir = tmp_path / "run"
+    rundir.mkdir()
+    process = subprocess.Popen(
+        [sys.executable, "-c", "input()"],
+        stdin=subprocess.PIPE,
+    )
+    client, server_socket = socket.socketpair()
+    return KaTeXServer(rundir, process, client), server_socket
+
+
+def test_katex_server_partial_response(tmp_path):
+    """Test a timeout in the middle of a response closes the connection."""
+    server, server_socket = fake_server(tmp_path)
+    previous = KaTeXServer.katex_server
+    KaTeXServer.katex_server = server
+    try:
+        # Length of the response, followed by only a part of it
+        server_socket.sendall(KaTeXServer.LENGTH_STRUCT.pack(100) + b"{")
+        with pytest.raises(socket.timeout):
+            server.render({"latex": "x"}, timeout=0.1)
+        assert server.sock.fileno() == -1
+        assert server.process.poll() is not None
+        assert KaTeXServer.katex_server is None
+    finally:
+        server_socket.close()
+        KaTeXServer.katex_server = previous
+
+
+def test_katex_server_timeout_between_responses(tmp_path):
+    """Test a timeout between responses keeps the connection."""
+    server, server_socket = fake_server(tmp_path)
+    try:
+        with pytest.raises(socket.timeout):
+            server.render({"latex": "x"}, timeout=0.1)
+        assert server.sock.fileno() != -1
+        assert server.process.poll() is None
+    finally:
+        server.terminate()
+        server_socket.close()
+
+
+@requires_node
+def test_render_latex_batch():
+    """Test rendering several equations with a single request."""
+    KaTeXServer.katex_path = None
+    equations = [
+        ("x", None),
+        (r"\sum_i x_i", {"displayMode": True}),
+        ("x", None),
+        (r"\frac{", {"throwOnError": True}),
+    ]
+    results = render_latex_batch(equations)
+    assert results[0] == results[2]
+    assert results[0].startswith('<span class="katex">')
+    assert results[1].startswith('<span class="katex-display">')
+    assert isinstance(results[3], KaTeXError)
+
+
+@requires_node
+@pytest.mark.parametrize("protocol", ["binary", "json"])
+def test_render_latex_batch_protocol(monkeypatch, protocol):
+    """Test equations of a batch use the binary format if selected."""
+    encoded = []
+    encode = KaTeXServer.encode
+
+    def spy(self, request):
+        parts = encode(self, request)
+        encoded.append(parts[0][:1])
+        return parts
+
+    monkeypatch.setattr(KaTeXServer, "encode", spy)
+    KaTeXServer.katex_path = None
+    KaTeXServer.protocol = protocol
+    try:
+        equations = [(rf"\text{{{protocol}}}_{{{n}}}", None) for n in range(3)]
+        results = render_latex_batch(equations)
+    finally:
+        KaTeXServer.protocol = "binary"
+    for n, html in enumerate(results):
+        assert f">{n}</mn>" in html
+    if protocol == "binary":
+        assert encoded == [bytes([KaTeXServer.BINARY_VERSION])] * 3
+    else:
+        assert encoded == [b"{"]
+
+
+@requires_node
+def test_render_latex_batch_store():
+    """Test reusing equations stored for a document."""
+    KaTeXServer.katex_path = None
+    store = {}
+    equations = [("x", None), ("y", {"displayMode": True})]
+    results = render_latex_batch(equations, store)
+    assert sorted(store.values()) == sorted(results)
+    # Stored equations are used before rendering them again
+    for key in store:
+        store[key] = "stored"
+    assert render_latex_batch(equations, store) == ["stored", "stored"]
+
+
+@requires_node
+def test_render_latex_batch_stats():
+    """Test collecting render statistics."""
+    KaTeXServer.katex_path = None
+    stats = KaTeXStats(["a.rst:1", "a.rst:2", "a.rst:3"], slowest=1)
+    equations = [
+        (r"\sqrt{stats}", None),
+        (r"\sqrt{stats}", None),
+        (r"\frac{stats", {"throwOnError": True}),
+    ]
+    render_latex_batch(equations, stats=stats)
+    assert (stats.equations, stats.rendered, stats.errors) == (3, 2, 1)
+    assert stats.bytes_in == len(r"\sqrt{stats}") + len(r"\frac{stats")
+    assert stats.bytes_out > 0
+    assert len(stats.times) == 2
+    assert all(t > 0 for t in stats.render_times)
+    assert all(t >= r for t, r in zip(stats.times, stats.render_times))
+    # Only the slowest equation is kept, with its source location
+    assert len(stats.slowest) == 1
+    assert stats.slowest[0][2] in ["a.rst:1", "a.rst:3"]
+
+    total = KaTeXStats()
+    total.merge(stats, "a")
+    total.merge(stats, "b")
+    assert total.rendered == 4
+    summary = total.summary()
+    assert summary["documents"]["a"]["rendered"] == 2
+    assert summary["time_percentiles"]["100"] == max(stats.times)
+    # Totals, times, percentiles, and the slowest equation of each document
+    assert len(total.report()) == 4 + 1 + 2
+
+
+@requires_node
+def test_katex_server_render_timeout(monkeypatch):
+    """Test replacing a rendering worker exceeding the render timeout."""
+    monkeypatch.setattr("sphinxcontrib.katex.RENDER_TIMEOUT", 0.05)
+    KaTeXServer.katex_path = None
+    KaTeXServer.threads = 1
+    server = KaTeXServer.start()
+    try:
+        slow = {"latex": r"\sum_i x " * 5000}
+        response = server.render(slow, timeout=5.0)
+        assert response["error"] == "Rendering took longer than 50 ms"
+        # The replacement loads KaTeX before the deadline starts
+        for _ in range(3):
+            response = server.render({"latex": "x"}, timeout=5.0)
+            assert response["html"].startswith('<span class="katex">')
+    finally:
+        server.terminate()
+        KaTeXServer.threads = 0
+
+
+@requires_node
+def test_render_latex_batch_render_timeout(monkeypatch):
+    """Test only equations exceeding the render timeout fail."""
+    monkeypatch.setattr("sphinxcontrib.katex.RENDER_TIMEOUT", 0.2)
+    KaTeXServer.katex_path = None
+    KaTeXServer.threads = 1
+    if KaTeXServer.katex_server is not None:
+        KaTeXServer.katex_server.terminate()
+        KaTeXServer.katex_server = None
+    try:
+        equations = [("x", None), (r"\sum_i x " * 5000, None), ("y", None)]
+        results = render_latex_batch(equations)
+    finally:
+        KaTeXServer.katex_server.terminate()
+        KaTeXServer.katex_server = None
+        KaTeXServer.threads = 0
+    assert isinstance(results[1], KaTeXError)
+    assert str(results[1]) == "Rendering took longer than 200 ms"
+    for html in [results[0], results[2]]:
+        assert html.startswith('<span class="katex">')
+
+
+@requires_node
+def test_katex_server_broken_worker(tmp_path):
+    """Test workers failing to load KaTeX are not restarted forever."""
+    katex_path = tmp_path / "broken.js"
+    katex_path.write_text('throw new Error("broken");')
+    KaTeXServer.katex_path = str(katex_path)
+    KaTeXServer.threads = 2
+    server = KaTeXServer.start()
+    try:
+        response = server.render({"latex": "x"}, timeout=5.0)
+        assert response["error"].startswith("Rendering worker could not")
+        assert "broken" in response["error"]
+    finally:
+        server.terminate()
+        KaTeXServer.katex_path = None
+        KaTeXServer.threads = 0
+
+
+@requires_node
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs os.fork()")
+def test_katex_server_fork():
+    """Test forked processes start their own render server."""
+    KaTeXServer.katex_path = None
+    parent_server = KaTeXServer.get()
+    expected = parent_server.render({"latex": "x"}, timeout=5.0)["html"]
+    pid = os.fork()
+    if pid == 0:
+        # Child process, report the result by the exit code
+        code = 1
+        try:
+            server = KaTeXServer.get()
+            response = server.render({"latex": "x"}, timeout=5.0)
+            if server is not parent_server and response["html"] == expected:
+                code = 0
+            server.terminate()
+        finally:
+            os._exit(code)
+    _, status = os.waitpid(pid, 0)
+    assert os.WEXITSTATUS(status) == 0
+    # The server of the parent is not affected by the child
+    assert KaTeXServer.get() is parent_server
+    response = parent_server.render({"latex": "x"}, timeout=5.0)
+    assert response["html"] == expected
+
+
+@requires_node
+def test_katex_server_warm_start():
+    """Test connecting to a server started in the background."""
+    KaTeXServer.katex_path = None
+    previous = KaTeXServer.katex_server
+    KaTeXServer.katex_server = None
+    try:
+        KaTeXServer.warm_start()
+        server = KaTeXServer.katex_server
+        assert server is not None
+        assert server.sock is None
+        # A second warm start keeps the starting server
+        KaTeXServer.warm_start()
+        assert KaTeXServer.katex_server is server
+        assert KaTeXServer.get() is server
+        assert server.sock is not None
+        response = server.render({"latex": "x"}, timeout=5.0)
+        assert response["html"].startswith('<span class="katex">')
+    finally:
+        if KaTeXServer.katex_server is not None:
+            KaTeXServer.katex_server.terminate()
+        KaTeXServer.katex_server = previous
+
+
+def test_env_purge_doc_and_merge_info():
+    """Test pre-rendered equations follow the documents of the env."""
+    stats = KaTeXStats()
+    env = types.SimpleNamespace(
+        katex_prerendered={"a": {"x": "<a>"}, "b": {"y": "<b>"}},
+        katex_stats={"a": stats, "b": KaTeXStats()},
+    )
+    env_purge_doc(None, env, "b")
+    env_purge_doc(None, env, "missing")
+    assert env.katex_prerendered == {"a": {"x": "<a>"}}
+    assert env.katex_stats == {"a": stats}
+
+    # Documents read by a parallel worker
+    other = types.SimpleNamespace(
+        katex_prerendered={"b": {"y": "<c>"}, "c": {"z": "<d>"}},
+        katex_stats={"b": stats},
+    )
+    env_merge_info(None, env, ["b", "c", "d"], other)
+    assert env.katex_prerendered == {
+        "a": {"x": "<a>"},
+        "b": {"y": "<c>"},
+        "c": {"z": "<d>"},
+    }
+    assert env.katex_stats == {"a": stats, "b": stats}
+
+    # Environments without pre-rendered equations
+    env = types.SimpleNamespace()
+    env_merge_info(None, env, ["a"], types.SimpleNamespace())
+    env_purge_doc(None, env, "a")
+    assert env.katex_prerendered == {}
+
+
+def test_env_get_outdated():
+    """Test all documents are read again after the library changed."""
+    env = types.SimpleNamespace(found_docs={"a", "b", "c"})
+    app = types.SimpleNamespace()
+    assert env_get_outdated(app, env, set(), {"a"}, set()) == []
+    app._katex_library_changed = True
+    assert env_get_outdated(app, env, set(), {"a"}, set()) == ["a", "b", "c"]
+
+
+@requires_node
+def test_katex_server_render_iter():
+    """Test pipelined rendering of several requests."""
+    KaTeXServer.katex_path = None
+    server = KaTeXServer.get()
+    requests = [
+        {"latex": f"x_{{{n}}}", "katex_options": {}} for n in range(100)
+    ]
+    responses = dict(server.render_iter(requests, timeout=5.0, window=8))
+    assert sorted(responses) == list(range(100))
+    for n, response in responses.items():
+        expected = server.render(requests[n], timeout=5.0)
+        assert response["html"] == expected["html"]
+
+
+@requires_node
+def test_katex_server_pool():
+    """Test rendering on a pool of render servers."""
+    KaTeXServer.katex_path = None
+    pool = KaTeXServerPool.start(processes=2)
+    try:
+        requests = [
+            {"latex": f"x_{{{n}}}", "katex_options": {}} for n in range(20)
+        ]
+        responses = pool.render_many(requests, timeout=5.0)
+        assert len(responses) == len(requests)
+        for request, response in zip(requests, responses):
+            expected = pool.render(request, timeout=5.0)
+            assert response["html"] == expected["html"]
+    finally:
+        pool.terminate()
+
+
+def test_async_katex_server_invalid_response():
+    """Test an invalid response fails the waiting requests."""
+    client, server_socket = socket.socketpair()
+
+    async def render():
+        reader, writer = await asyncio.open_connection(sock=client)
+        server = AsyncKaTeXServer(KaTeXServer(None, None), reader, writer)
+        task = asyncio.ensure_future(server.render({"latex": "x"}))
+        await asyncio.sleep(0.01)
+        server_socket.sendall(KaTeXServer.LENGTH_STRUCT.pack(3) + b"{x}")
+        with pytest.raises(KaTeXError, match="Invalid response"):
+            await asyncio.wait_for(task, 5.0)
+        with pytest.raises(KaTeXError):
+            await server.render({"latex": "y"})
+        await server.close()
+
+    try:
+        asyncio.run(render())
+    finally:
+        server_socket.close()
+
+
+@requires_node
+@pytest.mark.parametrize("threads", [0, 2])
+def test_katex_server_compile_cache(tmp_path, threads):
+    """Test reusing the compiled KaTeX library."""
+    KaTeXServer.katex_path = None
+    KaTeXServer.threads = threads
+    KaTeXServer.compile_cache = tmp_path / "cache"
+
+    def render():
+        server = KaTeXServer.start()
+        try:
+            return server.render({"latex": "x"}, timeout=5.0)["html"]
+        finally:
+            server.terminate()
+
+    try:
+        expected = render()
+        files = list(KaTeXServer.compile_cache.glob("*-node*/*"))
+        if threads == 0:
+            assert len(files) == 1
+        # Reused and invalid cached code
+        assert render() == expected
+        for file in files:
+            file.write_bytes(b"invalid")
+        assert render() == expected
+        # Fallback to compiling on every start
+        KaTeXServer.compile_cache = tmp_path / "file"
+        KaTeXServer.compile_cache.write_text("")
+        assert render() == expected
+        # Other users could place code in a shared directory
+        KaTeXServer.compile_cache = tmp_path / "shared"
+        KaTeXServer.compile_cache.mkdir(mode=0o755)
+        KaTeXServer.compile_cache.chmod(0o755)
+        assert render() == expected
+        assert not list(KaTeXServer.compile_cache.iterdir())
+    finally:
+        KaTeXServer.threads = 0
+        KaTeXServer.compile_cache = None
+
+
+def test_compile_cache_directory(tmp_path, monkeypatch):
+    """Test the compiled KaTeX library is stored in a private directory."""
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    monkeypatch.setenv("LOCALAPPDATA", str(tmp_path))
+    path = compile_cache_directory()
+    assert path == tmp_path / "sphinxcontrib_katex" / "compile_cache"
+    assert path.is_dir()
+    if hasattr(os, "getuid"):
+        assert path.stat().st_mode & 0o777 == 0o700
+        # Other users could place code in the directory
+        path.chmod(0o775)
+        assert compile_cache_directory() is None
+
+
+@requires_node
+@pytest.mark.parametrize("transport", ["socket", "tcp"])
+def test_async_katex_server(transport):
+    """Test rendering concurrently from asyncio tasks."""
+    KaTeXServer.katex_path = None
+    KaTeXServer.transport = transport
+
+    async def render():
+        async with await AsyncKaTeXServer.start(window=8) as server:
+            requests = [{"latex": f"x_{{{n}}}"} for n in range(100)]
+            responses = await server.render_many(requests, timeout=5.0)
+            for request, response in zip(requests, responses):
+                expected = await server.render(request, timeout=5.0)
+                assert response["html"] == expected["html"]
+
+            # Timed out and cancelled requests do not disturb later ones
+            with pytest.raises(asyncio.TimeoutError):
+                await server.render({"latex": r"\sum" * 1000}, timeout=1e-6)
+            task = asyncio.ensure_future(server.render({"latex": "y"}))
+            await asyncio.sleep(0)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            response = await server.render({"latex": "z"}, timeout=5.0)
+            assert ">z</mi>" in response["html"]
+            assert not server.pending
+        with pytest.raises(KaTeXError):
+            await server.render({"latex": "x"})
+
+    try:
+        asyncio.run(render())
+    finally:
+        KaTeXServer.transport = "socket"
+
+
+@requires_node
+@pytest.mark.parametrize("transport", ["socket", "tcp", "stdio"])
+@pytest.mark.parametrize("protocol", ["binary", "json"])
+def test_katex_server_transport(transport, protocol):
+    """Test rendering over the available transports and formats."""
+    KaTeXServer.katex_path = None
+    KaTeXServer.transport = transport
+    KaTeXServer.protocol = protocol
+    server = KaTeXServer.start()
+    try:
+        response = server.render({"latex": "x"}, timeout=5.0)
+        assert response["html"].startswith('<span class="katex">')
+        response = server.render(
+            {"latex": "ω", "katex_options": {"displayMode": True}},
+            timeout=5.0,
+        )
+        assert response["html"].startswith('<span class="katex-display">')
+        response = server.render(
+            {"latex": r"\frac{", "katex_options": {"throwOnError": True}},
+            timeout=5.0,
+        )
+        assert response["error"].startswith("KaTeX parse error")
+    finally:
+        server.terminate()
+        KaTeXServer.transport = "socket"
+        KaTeXServer.protocol = "binary"
+
+
+@requires_node
+@pytest.mark.parametrize("protocol", ["binary", "json"])
+def test_katex_server_option_set(protocol):
+    """Test rendering with a registered option set."""
+    KaTeXServer.katex_path = None
+    KaTeXServer.protocol = protocol
+    options = convert_katex_options(
+        r'macros: {"\\RR": "\\mathbb{R}"}, throwOnError: false,'
+    )
+    name = KaTeXServer.add_option_set(dict({"throwOnError": True}, **options))
+    server = KaTeXServer.start()
+    try:
+        requests = [
+            {"latex": r"x \in \RR", "options": name},
+            {
+                "latex": r"\RR",
+                "katex_options": {"displayMode": True},
+                "options": name,
+            },
+            {"latex": r"\frac{", "options": name},
+        ]
+        responses = [server.render(r, timeout=5.0) for r in requests]
+        assert "mathbb" in responses[0]["html"]
+        assert responses[1]["html"].startswith('<span class="katex-display">')
+        # throwOnError from the Javascript options takes precedence
+        assert "katex-error" in responses[2]["html"]
+    finally:
+        server.terminate()
+        KaTeXServer.protocol = "binary"
+
+
+@requires_node
+def test_convert_katex_options():
+    """Test katex_options of conf.py are converted before registering."""
+    assert convert_katex_options("") == {}
+    assert convert_katex_options("strict: false, trust: () => true,") == {
+        "strict": False,
+    }
+    with pytest.raises(KaTeXError, match="Invalid katex_options"):
+        convert_katex_options("macros:")
+
+
+@requires_node
+def test_katex_server_option_set_code(tmp_path):
+    """Test the server does not evaluate code sent by clients."""
+    KaTeXServer.katex_path = None
+    path = tmp_path / "evaluated"
+    code = "a: process.mainModule.require('fs').writeFileSync({}, ''),"
+    code = code.format(json.dumps(str(path)))
+    server = KaTeXServer.start()
+    try:
+        registration = {"register": "code", "katex_options_js": code}
+        assert server.render(registration)["registered"] == "code"
+        server.registered.add("code")
+        response = server.render({"register": "text", "katex_options": code})
+        assert response["error"].startswith("Invalid katex_options")
+        response = server.render({"latex": "x", "options": "code"})
+        assert response["html"].startswith('<span class="katex">')
+        assert not path.exists()
+    finally:
+        server.terminate()
+
+
+@requires_node
+@pytest.mark.parametrize("port", [None, 0])
+def test_katex_server_daemon(tmp_path, capsys, port):
+    """Test sharing a render server started as daemon."""
+    KaTeXServer.katex_path = None
+    rundir = tmp_path / "run"
+    args = ["daemon", "start", "--rundir", str(rundir)]
+    if port is not None:
+        args += ["--port", str(port)]
+    assert main(args) == 0
+    address = capsys.readouterr().out.strip()
+    try:
+        assert main(["daemon", "status", "--rundir", str(rundir)]) == 0
+        # Connections can be closed without stopping the daemon
+        for _ in range(2):
+            server = KaTeXServer.attach(address)
+            response = server.render({"latex": "x", "katex_options": {}})
+            assert response["html"].startswith('<span class="katex">')
+            server.terminate()
+    finally:
+        assert main(["daemon", "stop", "--rundir", str(rundir)]) == 0
+    assert main(["daemon", "status", "--rundir", str(rundir)]) == 1
+
+
+@requires_node
+def test_katex_server_daemon_library(tmp_path, capsys):
+    """Test equations are stored under the library of the daemon."""
+    KaTeXServer.katex_path = None
+    local_hash = katex_library_hash()
+    katex_path = tmp_path / "katex.min.js"
+    shutil.copy(KaTeXServer.katex_file(), katex_path)
+    with open(katex_path, "a") as file:
+        file.write("\n// Another build of KaTeX\n")
+    rundir = tmp_path / "run"
+    args = ["daemon", "start", "--rundir", str(rundir)]
+    assert main(args + ["--katex", str(katex_path)]) == 0
+    address = capsys.readouterr().out.strip()
+    try:
+        KaTeXServer.address = address
+        expected = hashlib.sha256(katex_path.read_bytes()).hexdigest()
+        assert katex_library_hash() == expected
+        assert katex_library_hash() != local_hash
+        cache = KaTeXCache(tmp_path / "cache", 1024)
+        assert cache.katex_hash == expected
+    finally:
+        KaTeXServer.address = None
+        KaTeXServer.katex_path = None
+        assert main(["daemon", "stop", "--rundir", str(rundir)]) == 0
+
+
+@pytest.mark.skipif(not hasattr(os, "getuid"), reason="needs POSIX")
+def test_katex_server_daemon_directory(tmp_path, capsys):
+    """Test the daemon state is only used from a private directory."""
+    rundir = tmp_path / "run"
+    assert private_directory(rundir) == rundir
+    assert rundir.stat().st_mode & 0o777 == 0o700
+
+    # Other users could replace the state
+    rundir.chmod(0o755)
+    with pytest.raises(KaTeXError):
+        private_directory(rundir)
+    assert main(["daemon", "status", "--rundir", str(rundir)]) == 1
+    assert "not accessible by other users" in capsys.readouterr().err
+    link = tmp_path / "link"
+    link.symlink_to(tmp_path / "elsewhere", target_is_directory=True)
+    (tmp_path / "elsewhere").mkdir(mode=0o700)
+    with pytest.raises(KaTeXError):
+        private_directory(link)
+
+    # Only render daemons are stopped
+    rundir.chmod(0o700)
+    process = subprocess.Popen(
+        [sys.executable, "-c", "input()"],
+        stdin=subprocess.PIPE,
+    )
+    try:
+        state = {"pid": process.pid, "address": "1"}
+        (rundir / "daemon.json").write_text(json.dumps(state))
+        assert main(["daemon", "stop", "--rundir", str(rundir)]) == 1
+        assert process.poll() is None
+        assert not (rundir / "daemon.json").exists()
+    finally:
+        process.kill()
+        process.wait()
+
+
+@requires_node
+def test_render_command(tmp_path, capsys):
+    """Test rendering equations from the command line."""
+    KaTeXServer.katex_path = None
+    equations = tmp_path / "equations.jsonl"
+    equations.write_text(
+        "x^2\n"
+        "\n"
+        '{"latex": "\\\\sum_i", "display": true, "id": "sum"}\n'
+        "\\frac{\n"
+    )
+    cache = tmp_path / "cache"
+    try:
+        assert (
+            main(
+                [
+                    "render",
+                    str(equations),
+                    "--processes",
+                    "2",
+                    "--options",
+                    '{"throwOnError": true}',
+                    "--cache",
+                    str(cache),
+                ]
+            )
+            == 1
+        )
+    finally:
+        KaTeXServer.option_set = None
+        KaTeXServerPool.processes = 1
+        KaTeXCache.katex_cache = None
+    output = capsys.readouterr()
+    results = [json.loads(line) for line in output.out.splitlines()]
+    assert len(results) == 3
+    assert results[0]["html"].startswith('<span class="katex">')
+    assert results[1]["id"] == "sum"
+    assert results[1]["html"].startswith('<span class="katex-display">')
+    assert results[2]["error"].startswith("KaTeX parse error")
+    assert "Rendered 3 equations with 1 errors" in output.err
+    assert os.listdir(cache)
+
+    equations.write_text('{"display": true}\n')
+    assert main(["render", str(equations)]) == 1
+    assert "Invalid equation" in capsys.readouterr().err
+
+    # Missing files are reported without a traceback
+    assert main(["render", str(equations), str(tmp_path / "missing")]) == 1
+    assert "No such file" in capsys.readouterr().err
+
+
+class ElementParser(HTMLParser):
+    """List of tags with their attributes and text of HTML."""
+
+    def __init__(self, html, styles=None):
+        super().__init__(convert_charrefs=False)
+        # Class names of minified styles
+        self.classes = {name: style for style, name in (styles or {}).items()}
+        self.elements = []
+        self.feed(html)
+
+    def handle_starttag(self, tag, attrs):
+        attributes = dict(attrs)
+        if tag in ("math", "svg"):
+            attributes.pop("xmlns", None)
+        classes = []
+        for name in attributes.pop("class", "").split():
+            if name in self.classes:
+                attributes["style"] = self.classes[name]
+            else:
+                classes.append(name)
+        if classes:
+            attributes["class"] = " ".join(classes)
+        self.elements.append((tag, attributes))
+
+    def handle_endtag(self, tag):
+        self.elements.append(("/" + tag, {}))
+
+    def handle_data(self, data):
+        self.elements.append(("", data))
+
+
+@requires_node
+def test_minify_katex_html():
+    """Test minified equations are rendered the same."""
+    KaTeXServer.katex_path = None
+    styles = {}
+    for latex, options in [
+        (r"\sqrt{x^2+\frac{a}{b}} \int_0^1 \mathbb{R}", {"displayMode": True}),
+        (r"\left(\begin{matrix} a & b \\\\ c & d \end{matrix}\right)", None),
+        (r"\color{red} x \overbrace{a+b}^{n}", None),
+    ]:
+        html = render_latex(latex, options)
+        minified = minify_katex_html(html, styles)
+        assert len(minified) < len(html)
+        assert " style=" not in minified
+        assert "xmlns=" not in minified
+        # Same elements, attributes and styles after expanding the classes
+        expected = ElementParser(html).elements
+        assert ElementParser(minified, styles).elements == expected
+
+        # XHTML documents need the namespaces
+        minified = minify_katex_html(html, styles, keep_namespaces=True)
+        assert " style=" not in minified
+        assert minified.count("xmlns=") == html.count("xmlns=") > 0
+        assert ElementParser(minified, styles).elements == expected
+
+
+def test_writes_xhtml():
+    """Test namespaces are only removed from HTML documents."""
+    for name, suffix, expected in [
+        ("html", ".html", False),
+        ("dirhtml", ".html", False),
+        ("html", ".xhtml", True),
+        ("epub", ".xhtml", True),
+    ]:
+        builder = types.SimpleNamespace(name=name, out_suffix=suffix)
+        assert writes_xhtml(builder) == expected
@@ -0,0 +1,188 @@
+import gzip
+import os
+import types
+
+from sphinxcontrib.katex import compressors
+from sphinxcontrib.katex import copy_katex_css
+from sphinxcontrib.katex import katex_used_classes
+from sphinxcontrib.katex import precompress_pages
+from sphinxcontrib.katex import prune_static_path
+from sphinxcontrib.katex import setup_static_path
+from sphinxcontrib.katex import trim_katex_css
+from sphinxcontrib.katex import write_static_file
+
+
+def static_app(tmp_path, fingerprint=True, precompress=False):
+    config = types.SimpleNamespace(
+        html_static_path=[],
+        katex_static_fingerprint=fingerprint,
+        katex_precompress=precompress,
+    )
+    app = types.SimpleNamespace(
+        config=config,
+        doctreedir=str(tmp_path),
+        outdir=str(tmp_path / "html"),
+    )
+    setup_static_path(app)
+    return app
+
+
+def test_write_static_file(tmp_path):
+    """Test fingerprinted static files are only written when changed."""
+    app = static_app(tmp_path)
+    name = write_static_file(app, "katex.min.js", b"a")
+    assert name.startswith("katex.min.") and name.endswith(".js")
+    assert app._katex_static_path in app.config.html_static_path
+    path = os.path.join(app._katex_static_path, name)
+    os.utime(path, (0, 0))
+
+    # Unchanged files are not written again
+    app = static_app(tmp_path)
+    assert write_static_file(app, "katex.min.js", b"a") == name
+    assert os.path.getmtime(path) == 0
+
+    # Changed files get a new name and old files are removed,
+    # also from the output
+    output_path = tmp_path / "html" / "_static"
+    output_path.mkdir(parents=True)
+    (output_path / name).write_bytes(b"a")
+    (output_path / "custom.css").write_bytes(b"")
+    app = static_app(tmp_path)
+    new_name = write_static_file(app, "katex.min.js", b"b")
+    assert new_name != name
+    prune_static_path(app)
+    assert os.listdir(app._katex_static_path) == [new_name]
+    assert os.listdir(output_path) == ["custom.css"]
+
+
+def test_write_static_file_without_fingerprint(tmp_path):
+    """Test static files keep their name without fingerprints."""
+    app = static_app(tmp_path, fingerprint=False)
+    assert write_static_file(app, "katex-math.css", b"a") == "katex-math.css"
+
+
+def test_write_static_file_precompress(tmp_path):
+    """Test compressed copies are only written when the file changed."""
+    extensions = list(compressors())
+    app = static_app(tmp_path, fingerprint=False, precompress=True)
+    assert write_static_file(app, "katex-math.css", b"a" * 100)
+    assert write_static_file(app, "fonts/KaTeX_Main-Regular.woff2", b"a")
+    path = os.path.join(app._katex_static_path, "katex-math.css")
+    for ext in extensions:
+        os.utime(path + ext, (0, 0))
+    with open(path + ".gz", "rb") as file:
+        assert gzip.decompress(file.read()) == b"a" * 100
+    assert sorted(app._katex_static_files) == sorted(
+        ["fonts/KaTeX_Main-Regular.woff2", "katex-math.css"]
+        + ["katex-math.css" + ext for ext in extensions]
+    )
+
+    # Unchanged files are not compressed again
+    app = static_app(tmp_path, fingerprint=False, precompress=True)
+    write_static_file(app, "katex-math.css", b"a" * 100)
+    for ext in extensions:
+        assert os.path.getmtime(path + ext) == 0
+    app = static_app(tmp_path, fingerprint=False, precompress=True)
+    write_static_file(app, "katex-math.css", b"b" * 100)
+    for ext in extensions:
+        assert os.path.getmtime(path + ext) != 0
+
+    # Outdated copies are removed from the output
+    output_path = tmp_path / "html" / "_static"
+    output_path.mkdir(parents=True)
+    for ext in [".gz", ".br"]:
+        (output_path / f"katex-math.css{ext}").write_bytes(b"")
+    app = static_app(tmp_path, fingerprint=False, precompress=True)
+    write_static_file(app, "katex-math.css", b"b" * 100)
+    assert sorted(os.listdir(output_path)) == [
+        f"katex-math.css{ext}" for ext in [".br", ".gz"]
+    ]
+    write_static_file(app, "katex-math.css", b"c" * 100)
+    assert os.listdir(output_path) == []
+
+    # Compressed copies are removed with precompress disabled
+    for ext in [".gz", ".br"]:
+        (output_path / f"katex-math.css{ext}").write_bytes(b"")
+    app = static_app(tmp_path, fingerprint=False)
+    write_static_file(app, "katex-math.css", b"c" * 100)
+    prune_static_path(app)
+    files = os.listdir(app._katex_static_path)
+    assert not [name for name in files if name.startswith("katex-math.css.")]
+    assert os.listdir(output_path) == []
+
+
+def test_precompress_pages(tmp_path):
+    """Test compressing pages with many pre-rendered equations."""
+    for docname in ["few", "many"]:
+        (tmp_path / f"{docname}.html").write_text(docname)
+    app = types.SimpleNamespace(
+        builder=types.SimpleNamespace(
+            get_outfilename=lambda docname: tmp_path / f"{docname}.html",
+        ),
+        config=types.SimpleNamespace(katex_precompress_pages=2),
+        env=types.SimpleNamespace(
+            found_docs={"few", "many", "missing"},
+            katex_prerendered={
+                "few": {("x", "{}"): "x"},
+                "many": {("x", "{}"): "x", ("y", "{}"): "y"},
+            },
+        ),
+    )
+    precompress_pages(app)
+    with open(tmp_path / "many.html.gz", "rb") as file:
+        assert gzip.decompress(file.read()) == b"many"
+    assert not (tmp_path / "few.html.gz").exists()
+
+    # Outdated copies are removed, also without brotli installed
+    (tmp_path / "many.html.br").write_bytes(b"")
+    app.env.katex_prerendered["many"] = {}
+    precompress_pages(app)
+    assert sorted(os.listdir(tmp_path)) == ["few.html", "many.html"]
+
+
+KATEX_CSS = (
+    "@font-face{font-family:KaTeX_AMS;font-style:normal;font-weight:400;"
+    'src:url(fonts/KaTeX_AMS-Regular.woff2) format("woff2"),'
+    'url(fonts/KaTeX_AMS-Regular.woff) format("woff")}'
+    "@font-face{font-family:KaTeX_Main;font-style:normal;font-weight:400;"
+    'src:url(fonts/KaTeX_Main-Regular.woff2) format("woff2"),'
+    'url(fonts/KaTeX_Main-Regular.woff) format("woff")}'
+    ".katex{font:normal 1.21em KaTeX_Main,Times New Roman,serif}"
+    ".katex .mathbb,.katex .textbb{font-family:KaTeX_AMS}"
+)
+
+
+def test_trim_katex_css():
+    """Test removing fonts of unused classes."""
+    css = trim_katex_css(KATEX_CSS, {"katex", "mord"})
+    assert "KaTeX_Main-Regular.woff2" in css
+    assert "KaTeX_Main-Regular.woff)" not in css
+    assert "KaTeX_AMS-Regular" not in css
+    # Rules are kept
+    assert ".katex .mathbb,.katex .textbb{font-family:KaTeX_AMS}" in css
+
+    css = trim_katex_css(KATEX_CSS, {"katex", "mathbb"})
+    assert "KaTeX_AMS-Regular.woff2" in css
+
+
+def test_copy_katex_css(tmp_path):
+    """Test bundling KaTeX CSS and fonts needed by the equations."""
+    dist = tmp_path / "dist"
+    (dist / "fonts").mkdir(parents=True)
+    (dist / "katex.min.css").write_text(KATEX_CSS)
+    for font in ["AMS", "Main"]:
+        for ext in ["woff2", "woff"]:
+            (dist / "fonts" / f"KaTeX_{font}-Regular.{ext}").write_bytes(b"")
+    app = static_app(tmp_path / "doctrees")
+    app.confdir = str(tmp_path)
+    app.config.katex_dist_path = "dist"
+    store = {"index": {("x", "{}"): '<span class="katex"></span>'}}
+
+    name = copy_katex_css(app, katex_used_classes(store))
+    assert name.startswith("katex.min.") and name.endswith(".css")
+    assert sorted(app._katex_static_files) == [
+        "fonts/KaTeX_Main-Regular.woff2",
+        name,
+    ]
+    path = os.path.join(app._katex_static_path, "fonts")
+    assert os.listdir(path) == ["KaTeX_Main-Regular.woff2"]